@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Benchmark memory of an upload plan: list of split dicts with path strings vs compact plan.Plan
+
+Files are generated in memory (no disk scan): --dirs directories with --files files in total. Every mode runs in its own
+process and reports the peak RSS after planning and after serializing metadata (one json.dumps vs streamed splits).
+
+Example: PYTHONPATH=src python scripts/benchmark_plan_memory.py --files 2000000
+"""
+import os
+import sys
+import json
+import resource
+import argparse
+import tempfile
+import subprocess
+import s3split.plan
+
+
+def generate(files, dirs):
+    """yield (relative directory, file name, size) like a directory walk"""
+    per_dir = max(1, files // dirs)
+    for index in range(files):
+        directory = index // per_dir
+        yield f"dataset/part_{directory // 100:04d}/dir_{directory:06d}", f"image_{index:09d}.jpg", 100 * 1024 + index % 4096
+
+
+def plan_dicts(files, dirs, max_size):
+    """splits as before: a dict per split with a list of relative paths"""
+    splits = []
+    paths = []
+    size = 0
+    for directory, name, file_size in generate(files, dirs):
+        if size + file_size > max_size:
+            splits.append({'paths': paths, 'size': size, 'id': len(splits) + 1})
+            paths = []
+            size = 0
+        paths.append(os.path.join(directory, name))
+        size += file_size
+    splits.append({'paths': paths, 'size': size, 'id': len(splits) + 1})
+    return splits
+
+
+def plan_compact(files, dirs, max_size):
+    """splits in a plan.Plan"""
+    plan = s3split.plan.Plan()
+    size = 0
+    for directory, name, file_size in generate(files, dirs):
+        if size + file_size > max_size:
+            plan.add_split(size)
+            size = 0
+        plan.add_file(plan.directory(directory), name, file_size)
+        size += file_size
+    plan.add_split(size)
+    return plan
+
+
+def rss_mb():
+    """peak resident set size of this process in MB (linux reports KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(args):
+    base = rss_mb()
+    if args.mode == "dicts":
+        splits = plan_dicts(args.files, args.dirs, args.tar_size * 1024 * 1024)
+        planned = rss_mb()
+        with tempfile.TemporaryFile() as file:
+            file.write(json.dumps({'splits': splits}).encode('utf-8'))
+    else:
+        splits = plan_compact(args.files, args.dirs, args.tar_size * 1024 * 1024)
+        planned = rss_mb()
+        with tempfile.TemporaryFile() as file:
+            # Same streaming of S3Manager.upload_metadata
+            file.write(b'{"splits": [')
+            for index, split in enumerate(splits):
+                file.write((", " if index > 0 else "").encode('utf-8') + json.dumps(split.to_dict()).encode('utf-8'))
+            file.write(b']}')
+    print(json.dumps({'mode': args.mode, 'splits': len(splits), 'plan_mb': round(planned - base, 1),
+                      'metadata_mb': round(rss_mb() - base, 1)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', help='Number of files', type=int, default=1000000)
+    parser.add_argument('--dirs', help='Number of directories', type=int, default=10000)
+    parser.add_argument('--tar-size', help='Tar size in MB', type=int, default=1024)
+    parser.add_argument('--mode', help=argparse.SUPPRESS, choices=['dicts', 'compact'])
+    args = parser.parse_args()
+    if args.mode is not None:
+        run_mode(args)
+        return
+    print(f"{args.files} files in {args.dirs} directories, tar size {args.tar_size} MB")
+    print(f"{'plan':8} {'splits':>7} {'plan RSS':>10} {'peak RSS':>10}")
+    for mode in ['dicts', 'compact']:
+        output = subprocess.check_output([sys.executable, __file__, '--mode', mode, '--files', str(args.files),
+                                          '--dirs', str(args.dirs), '--tar-size', str(args.tar_size)])
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        print(f"{mode:8} {result['splits']:>7} {result['plan_mb']:>8} MB {result['metadata_mb']:>8} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Benchmark tar scheduling on a skewed dataset with simulated transfers (no S3 needed)
+
+Every multipart part holds one of --streams network streams for --part-ms milliseconds (the link is saturated
+with --streams parallel parts). Compare:
+- baseline: tars in split id order, every tar uploads its parts with its own pool of MULTIPART_CONCURRENCY threads
+- lpt: largest tars first, parts of all tars in a shared PartPool (idle threads help the big tars)
+
+Example: PYTHONPATH=src python scripts/benchmark_schedule.py --small 40 --big 2 --big-parts 64 --threads 4
+"""
+import time
+import argparse
+import threading
+import statistics
+import concurrent.futures
+import s3split.common
+import s3split.schedule
+
+
+def run(splits, threads, streams, part_seconds, lpt):
+    """return completion times of every tar in seconds"""
+    link = threading.Semaphore(streams)
+
+    def _part(seconds):
+        with link:
+            time.sleep(seconds)
+    part_pool = s3split.schedule.PartPool(threads * s3split.common.MULTIPART_CONCURRENCY) if lpt else None
+    start = time.time()
+    done = []
+
+    def _transfer(split):
+        parts = [(part_seconds,)] * split['parts']
+        if part_pool is not None:
+            part_pool.map(_part, parts, priority=split['size'])
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=s3split.common.MULTIPART_CONCURRENCY) as executor:
+                list(executor.map(lambda part: _part(*part), parts))
+        done.append(time.time() - start)
+    order = s3split.schedule.lpt_order(splits, s3split.schedule.split_cost) if lpt else splits
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(_transfer, split) for split in order]:
+            future.result()
+    if part_pool is not None:
+        part_pool.close()
+    return sorted(done)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--small', help='Small tars (a single part)', type=int, default=40)
+    parser.add_argument('--big', help='Big tars, created last (highest split ids)', type=int, default=2)
+    parser.add_argument('--big-parts', help='Parts of a big tar', type=int, default=64)
+    parser.add_argument('--threads', help='Parallel tars (--threads)', type=int, default=4)
+    parser.add_argument('--streams', help='Parallel parts saturating the simulated network link', type=int, default=16)
+    parser.add_argument('--part-ms', help='Simulated milliseconds to transfer a part', type=float, default=50)
+    args = parser.parse_args()
+    chunk = s3split.common.MULTIPART_CHUNKSIZE
+    splits = [{'id': i + 1, 'size': chunk, 'paths': ['file'], 'parts': 1} for i in range(args.small)]
+    splits += [{'id': args.small + i + 1, 'size': args.big_parts * chunk, 'paths': ['file'], 'parts': args.big_parts}
+               for i in range(args.big)]
+    ideal = sum(split['parts'] for split in splits) * args.part_ms / 1000 / args.streams
+    print(f"{len(splits)} tars, {sum(split['parts'] for split in splits)} parts, {args.threads} threads, {args.streams} streams")
+    print(f"{'schedule':10} {'makespan':>9} {'p50 tar':>9} {'last 10%':>9}")
+    for name, lpt in [("baseline", False), ("lpt", True)]:
+        done = run(splits, args.threads, args.streams, args.part_ms / 1000, lpt)
+        tail = done[-1] - done[int(len(done) * 0.9) - 1]
+        print(f"{name:10} {done[-1]:8.2f}s {statistics.median(done):8.2f}s {tail:8.2f}s")
+    print(f"(saturated link: {ideal:.2f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+"""s3split splits big datasets in different tar archives stored on S3"""
+
+
+def __getattr__(name):
+    # Lazy import: keep `import s3split` fast and free of boto3 for cli commands that do not need it
+    if name == "Dataset":
+        import s3split.dataset  # pylint: disable=import-outside-toplevel
+        return s3split.dataset.Dataset
+    if name in ("Config", "Result", "Session", "Uploader", "Downloader"):
+        import s3split.api  # pylint: disable=import-outside-toplevel
+        return getattr(s3split.api, name)
+    raise AttributeError(f"module 's3split' has no attribute '{name}'")
@@ -1,8 +1,10 @@
 """main actions: upload, check"""
 import os
 import time
+import shutil
 import threading
 import traceback
+import contextlib
 import concurrent.futures
 from pprint import pformat
 import tarfile
@@ -11,62 +13,396 @@ import s3split.s3util
 import s3split.common
 import s3split.common as com
 import s3split.stats
+import s3split.cache
+import s3split.tuning
+import s3split.metrics
+import s3split.schedule
+import s3split.journal
 
 
 class Action():
-    """manage actions"""
+    """manage actions
 
-    def __init__(self, args, event):
+    :param client_pool: s3util.ClientPool shared with other actions (default a new pool)
+    :param executor: thread pool shared with other actions (default a new pool for every transfer phase)
+    :param cb_progress: called with (event, fields) for every lifecycle event, from worker threads
+    :param part_pool: schedule.PartPool for multipart parts shared with other actions (default a new pool for every transfer phase)
+    """
+
+    def __init__(self, args, event, client_pool=None, executor=None, cb_progress=None, part_pool=None):
         self._args = args
         self._event = event
         self._logger = s3split.common.get_logger()
-        self._executor = None
-        if args.command == "upload":
-            self.upload()
-        elif args.command == "check":
-            if not self.check(s3split.s3util.S3Uri(self._args.target)):
-                raise ValueError("S3 check not passed")
-        elif args.command == "download":
-            if not self.check(s3split.s3util.S3Uri(self._args.source)):
-                raise ValueError("S3 check not passed")
-            self.download()
+        self._executor = executor
+        self._shared_part_pool = part_pool
+        self._part_pool = None
+        self._cb_progress = cb_progress
+        self._controller = None
+        self._events = None
+        self._segment_lock = threading.Lock()
+        if client_pool is None:
+            threads = args.threads_max if args.threads == "auto" else args.threads
+            client_pool = s3split.s3util.ClientPool(threads * s3split.common.MULTIPART_CONCURRENCY)
+        self._client_pool = client_pool
+
+    def run(self, raise_on_failure=True):
+        """run args.command, return a result dict (command, ok, tars, failed, stats)
+
+        With raise_on_failure a failed check, failed tars or an interruption raise ValueError.
+        """
+        if self._args.event_log is not None:
+            self._events = s3split.metrics.EventLog(self._args.event_log)
+        try:
+            if self._args.command == "upload":
+                result = self.upload()
+            elif self._args.command == "check":
+                result = self._result(self.check(s3split.s3util.S3Uri(self._args.target)))
+            elif not self.check(s3split.s3util.S3Uri(self._args.source)):
+                result = self._result(False)
+            else:
+                result = self.download() if self._args.command == "download" else self.repack()
+        finally:
+            if self._events is not None:
+                self._events.close()
+                self._events = None
+        if raise_on_failure and result['interrupted'] and len(result['failed']) == 0:
+            raise ValueError(f"{self._args.command.capitalize()} interrupted, {len(result['tars'])} tar(s) completed")
+        if raise_on_failure and not result['ok'] and len(result['failed']) == 0:
+            raise ValueError("S3 check not passed")
+        if raise_on_failure and len(result['failed']) > 0:
+            raise ValueError(f"{self._args.command.capitalize()} failed for {len(result['failed'])} tar(s): {', '.join(result['failed'])}")
+        return result
+
+    def _result(self, ok, tars=None, failed=None, stats=None):
+        """structured result of a command, tars not transferred because of an interruption are None"""
+        interrupted = None in (tars or [])
+        return {'command': self._args.command, 'ok': ok and not failed and not interrupted,
+                'tars': [tar for tar in tars or [] if tar is not None], 'failed': sorted(failed or []),
+                'stats': stats.snapshot() if stats is not None else None, 'interrupted': interrupted}
+
+    def _emit(self, event, **fields):
+        """send a lifecycle event to the event log and progress callback (if enabled)"""
+        if self._events is not None:
+            self._events.emit(event, command=self._args.command, **fields)
+        if callable(self._cb_progress):
+            self._cb_progress(event, {'command': self._args.command, **fields})
+
+    def _track(self, action, name, size, func, *args):
+        """run func logging started/completed/failed events with duration"""
+        start = time.time()
+        self._emit(f"{action}_started", name=name, bytes=size)
+        try:
+            result = func(*args)
+        except (Exception, SystemExit) as exc:
+            self._emit(f"{action}_failed", name=name, bytes=size, duration=round(time.time() - start, 3), error=str(exc))
+            raise
+        self._emit(f"{action}_completed", name=name, bytes=size, duration=round(time.time() - start, 3))
+        return result
+
+    def _s3_manager(self, s3uri, stats=None, multipart_state=None, endpoint=None):
+        """new S3Manager for s3uri (on endpoint, default --s3-endpoint), stats are updated with transferred bytes and retries"""
+        controller = self._controller
+
+        def _on_retry(ex, attempt, delay):
+            self._logger.warning(f"S3 request failed ({ex}), retry {attempt} of {self._args.retries} in {round(delay, 1)} seconds")
+            if stats is not None:
+                stats.incr("Retries")
+            if controller is not None:
+                controller.on_error()
+
+        def _on_update(file, byte, total_size):
+            stats.update(file, byte, total_size)
+            controller.on_bytes(byte)
+        cb_stats_update = stats.update if stats is not None else None
+        if controller is not None and stats is not None:
+            cb_stats_update = _on_update
+        return s3split.s3util.S3Manager(self._args.s3_access_key, self._args.s3_secret_key, endpoint or self._args.s3_endpoint,
+                                        self._args.s3_verify_certificate, s3uri.bucket, s3uri.object,
+                                        cb_stats_update, self._args.retries, _on_retry, multipart_state,
+                                        controller.on_request if controller is not None else None, self._client_pool, self._part_pool)
+
+    def _location(self, tar, s3uri):
+        """return (endpoint, s3uri) where a tar is stored, tars without a location are stored with metadata
+
+        A tar with a hashed key prefix is stored in a sub-prefix of its location path.
+        """
+        location = tar.get('location') if tar is not None else None
+        prefix = tar.get('prefix') if tar is not None else None
+        endpoint, bucket, path = (self._args.s3_endpoint, s3uri.bucket, s3uri.object) if location is None else \
+            (location['endpoint'], location['bucket'], location['path'])
+        if location is None and prefix is None:
+            return endpoint, s3uri
+        return endpoint, s3split.common.S3Uri(f"s3://{bucket}/{os.path.join(path, prefix or '')}".rstrip('/'))
+
+    def _list_tars(self, metadata, s3uri):
+        """list objects on every location used by metadata tars, return {(endpoint, bucket, key): S3 object}
+
+        Locations (stripes and hashed sub-prefixes) are listed in parallel, each one on its own key range.
+        """
+        def _run_list(endpoint, location_uri):
+            return endpoint, location_uri.bucket, self._s3_manager(location_uri, endpoint=endpoint).list_bucket_objects() or []
+
+        locations = {}
+        for tar in [tar for tar in metadata.get('tars') or [] if tar is not None] or [None]:
+            endpoint, location_uri = self._location(tar, s3uri)
+            locations[(endpoint, location_uri.bucket, location_uri.object)] = location_uri
+        futures = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(locations), 16)) as executor:
+            for (endpoint, bucket, path), location_uri in locations.items():
+                futures.update({executor.submit(_run_list, endpoint, location_uri): f"{endpoint} s3://{bucket}/{path}"})
+            results, failed = self._wait(futures)
+        if len(failed) > 0:
+            raise ValueError(f"Listing failed for {len(failed)} location(s): {', '.join(sorted(failed))}")
+        objects = {}
+        for endpoint, bucket, listed in results:
+            for obj in listed:
+                objects[(endpoint, bucket, obj['Key'])] = obj
+        return objects
+
+    def _restore_duplicates(self, splits, ids, stats):
+        """restore duplicates of a deduplicated dataset from extracted files, after all tars are extracted
+
+        An original outside --prefix was extracted only for its duplicates: it is moved to the first duplicate.
+        """
+        prefix = self._args.prefix.strip('/') if self._args.prefix is not None else None
+        restored = 0
+        for split in splits:
+            if split.get('id') not in ids:
+                continue
+            for original, copies in (split.get('duplicates') or {}).items():
+                copies = [copy for copy in copies if prefix is None or prefix in copy]
+                if len(copies) == 0:
+                    continue
+                for path in [original] + copies:
+                    if os.path.isabs(path) or '..' in path.split('/'):
+                        raise ValueError(f"Unsafe duplicate path {path}")
+                source = os.path.join(self._args.target, original)
+                if prefix is not None and prefix not in original:
+                    first = os.path.join(self._args.target, copies.pop(0))
+                    if os.path.exists(source):
+                        os.makedirs(os.path.dirname(first), exist_ok=True)
+                        os.replace(source, first)
+                    source = first
+                # A missing source is a failed download, not a duplicate silently skipped
+                if not os.path.isfile(source):
+                    raise ValueError(f"Duplicates of {original} not restored: {os.path.relpath(source, self._args.target)} not extracted")
+                if source != os.path.join(self._args.target, original):
+                    restored += 1
+                for copy in copies:
+                    path = os.path.join(self._args.target, copy)
+                    temp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.s3split-duplicate.tmp")
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    try:
+                        if self._args.duplicates != "hardlink":
+                            raise OSError("copy requested")
+                        os.link(source, temp)
+                    except OSError:
+                        shutil.copy2(source, temp)
+                    os.replace(temp, path)
+                    restored += 1
+        if restored > 0:
+            self._logger.info(f"Restored {restored} duplicate file(s) ({self._args.duplicates})")
+            if stats is not None:
+                stats.set("Duplicates restored", restored)
+
+    def _write_segment(self, tar, tarinfo, segment):
+        """write a huge file segment in place: the target file is preallocated once, segments of different tars run in parallel"""
+        if os.path.isabs(segment['path']) or '..' in segment['path'].split('/'):
+            raise ValueError(f"Unsafe segment path {segment['path']}")
+        path = os.path.join(self._args.target, segment['path'])
+        with self._segment_lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, tarinfo.mode or 0o644)
+        try:
+            if os.fstat(fd).st_size < segment['size']:
+                try:
+                    os.posix_fallocate(fd, 0, segment['size'])
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, segment['size'])
+            source = tar.extractfile(tarinfo)
+            offset = segment['offset']
+            while True:
+                data = source.read(s3split.common.MULTIPART_CHUNKSIZE // 8)
+                if not data:
+                    break
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def _executor_pool(self, stats=None):
+        """thread pool for transfers, export stats as metrics while the pool is running
+
+        Multipart parts of all transfers share a part pool: idle threads help the biggest transfers still running.
+        """
+        self._part_pool = self._shared_part_pool
+        if self._part_pool is None:
+            threads = self._args.threads_max if self._args.threads == "auto" else self._args.threads
+            self._part_pool = s3split.schedule.PartPool(threads * s3split.common.MULTIPART_CONCURRENCY)
+        exporter = None
+        if stats is not None and (self._args.metrics_port is not None or self._args.metrics_textfile is not None):
+            exporter = s3split.metrics.MetricsExporter(stats, self._args.metrics_port, self._args.metrics_textfile,
+                                                       self._args.stats_interval, {'command': self._args.command})
+            exporter.start()
+        try:
+            if self._args.threads == "auto":
+                with self._auto_executor_pool(stats) as executor:
+                    yield executor
+            elif self._executor is not None:
+                yield self._executor
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self._args.threads) as executor:
+                    yield executor
+        finally:
+            if exporter is not None:
+                exporter.stop()
+            if self._part_pool is not self._shared_part_pool:
+                self._part_pool.close()
+            self._part_pool = None
+
+    @contextlib.contextmanager
+    def _auto_executor_pool(self, stats):
+        """thread pool of --threads-max threads, running transfers are limited by an AIMD controller"""
+        def _on_change(limit, history):
+            stats.set("Concurrency (auto threads)", limit)
+            stats.set(f"Concurrency history (last {s3split.tuning.HISTORY_SIZE} changes, seconds:threads)", ", ".join(f"{elapsed}:{value}" for elapsed, value in history))
+        self._controller = s3split.tuning.ConcurrencyController(max_limit=self._args.threads_max,
+                                                                cb_change=_on_change if stats is not None else None)
+        self._controller.start()
+        try:
+            if self._executor is not None:
+                yield self._executor
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self._args.threads_max) as executor:
+                    yield executor
+        finally:
+            self._controller.stop()
+            history = ", ".join(f"{elapsed}:{value}" for elapsed, value in self._controller.history)
+            self._logger.info(f"Auto threads concurrency history (last {s3split.tuning.HISTORY_SIZE} changes, seconds:threads): {history}")
+            self._controller = None
+
+    def _submit(self, executor, func, *args):
+        """submit func to executor, with --threads auto func waits for a free slot of the controller"""
+        controller = self._controller
+        if controller is None:
+            return executor.submit(func, *args)
+
+        def _run():
+            with controller.slot():
+                return func(*args)
+        return executor.submit(_run)
+
+    def _wait(self, futures, stats=None):
+        """wait all futures, return results and names of failed futures (a failure does not stop other futures)"""
+        results = []
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                data = future.result()
+                results.append(data)
+                self._logger.debug(f"(future) completed - data: {data}")
+            except (Exception, SystemExit) as exc:  # pylint: disable=broad-except
+                failed.append(futures[future])
+                if stats is not None:
+                    stats.incr("Failed tars")
+                self._logger.error(f"(future) {futures[future]} generated an exception: {exc}")
+                self._logger.error(f"(future) generated an exception: {traceback.format_exc()}")
+        return results, failed
+
+    def _map(self, executor, func, items, name, stats=None):
+        """run func(*item) for every item, return results and names of failed items
+
+        Items are submitted while at most two futures per thread are pending: items (and data built for them)
+        are consumed as workers progress instead of materializing every future up front.
+        """
+        window = 2 * (self._args.threads_max if self._args.threads == "auto" else self._args.threads)
+        results = []
+        failed = []
+        pending = {}
+        for item in items:
+            pending[self._submit(executor, func, *item)] = name(item)
+            if len(pending) >= window:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                done_results, done_failed = self._wait({future: pending.pop(future) for future in done}, stats)
+                results += done_results
+                failed += done_failed
+        done_results, done_failed = self._wait(pending, stats)
+        return results + done_results, failed + done_failed
 
     def download(self):
         "download files from s3"
-        def _run_download(tmpdir, s3_obj, s3_size, s3uri, stats_cb):
+        def _run_download(tmpdir, s3_obj, tar_metadata, s3_etag, s3uri, stats, cache, segments, journal):
             def py_files(members):
                 for tarinfo in members:
+                    if tarinfo.name in segments:
+                        continue
                     # Remove container path added if someone open the archive on a desktop
                     tarinfo.name = tarinfo.name.replace('s3split', '').strip('/')
-                    if self._args.prefix is None:
-                        yield tarinfo
-                    elif self._args.prefix.strip('/') in tarinfo.name:
+                    if self._args.prefix is None or self._args.prefix.strip('/') in tarinfo.name or tarinfo.name in originals:
+                        # tarfile checks and creates parent directories without exist_ok: racy between parallel tars
+                        os.makedirs(os.path.join(self._args.target, os.path.dirname(tarinfo.name)), exist_ok=True)
+                        if tarinfo.isreg():
+                            # Extract to a temporary name renamed when the tar is completed: a file is never half written
+                            temp = os.path.join(os.path.dirname(tarinfo.name), f".{os.path.basename(tarinfo.name)}.{s3_obj}.tmp")
+                            renames.append((temp, tarinfo.name))
+                            tarinfo.name = temp
                         yield tarinfo
                     else:
                         self._logger.info(f"File skipped from untar (not in prefix {self._args.prefix.strip('/')}): {tarinfo.name}")
-            tar_file = os.path.join(tmpdir, os.path.basename(s3_obj))
-            self._logger.debug(f"(future) start download of s3 object '{s3_obj}' to local file '{tar_file}'")
-            s3manager = s3split.s3util.S3Manager(self._args.s3_access_key, self._args.s3_secret_key, self._args.s3_endpoint,
-                                                 self._args.s3_verify_certificate, s3uri.bucket, s3uri.object, stats_cb)
-            if self._event.is_set():
-                self._logger.warning(f"{s3_obj} - download interrupted because Ctrl + C was pressed!")
-                return None
-            with open(tar_file, 'wb') as file:
+
+            def fetch(file):
                 self._logger.info(f"{s3_obj} downloading... ")
                 s3manager.download_file(s3_obj, s3_size, file)
-                file.close()
                 self._logger.info(f"{s3_obj} download completed")
-            tar = tarfile.open(tar_file)
-            tar.extractall(path=self._args.target, members=py_files(tar))
-            tar.close()
+            self._logger.debug(f"(future) start download of s3 object '{s3_obj}'")
+            s3_size = tar_metadata.get('size') if tar_metadata is not None else None
+            endpoint, s3uri = self._location(tar_metadata, s3uri)
+            s3manager = self._s3_manager(s3uri, stats, endpoint=endpoint)
+            if self._event.is_set():
+                self._logger.warning(f"{s3_obj} - download interrupted because Ctrl + C was pressed!")
+                return None
+            if cache is None:
+                file = open(os.path.join(tmpdir, os.path.basename(s3_obj)), 'w+b')
+                self._track("download", s3_obj, s3_size, fetch, file)
+                file.seek(0)
+            else:
+                file, hit, evicted = cache.open(s3split.cache.TarCache.key(s3uri.bucket, s3uri.object, s3_obj, s3_etag), s3_size,
+                                                lambda file: self._track("download", s3_obj, s3_size, fetch, file))
+                if hit:
+                    self._logger.info(f"{s3_obj} served from local cache")
+                    stats.update(os.path.join(s3uri.object, s3_obj), s3_size, s3_size)
+                stats.incr("Cache hits" if hit else "Cache misses")
+                stats.incr("Cache evicted bytes", evicted)
+            segments = {os.path.join('s3split', s3split.common.segment_name(segment['path'], segment['offset'])): segment
+                        for segment in segments or []}
+            renames = []
+            with file:
+                tar = tarfile.open(fileobj=file)
+                for tarinfo in tar:
+                    segment = segments.get(tarinfo.name)
+                    if segment is not None and (prefix is None or prefix in segment['path'] or segment['path'] in originals):
+                        self._write_segment(tar, tarinfo, segment)
+                tar.extractall(path=self._args.target, members=py_files(tar))
+                tar.close()
+            for temp, final in renames:
+                os.replace(os.path.join(self._args.target, temp), os.path.join(self._args.target, final))
+            journal.done(s3_obj, prefix, len(renames))
             self._logger.info(f"{s3_obj} archive extracted")
+            self._emit("tar_extracted", name=s3_obj, bytes=s3_size)
             self._logger.info(f"Active threads: {threading.active_count()}")
             return s3_obj
 
         # --- ---
         s3uri = s3split.s3util.S3Uri(self._args.source)
-        if os.path.isdir(self._args.target):
-            raise ValueError(f"download target directory '{self._args.target}' exsists... Please provide a new path!")
+        if os.path.isdir(self._args.target) and not self._args.resume:
+            raise ValueError(f"download target directory '{self._args.target}' exsists... Please provide a new path or use --resume!")
+        s3_manager = self._s3_manager(s3uri)
+        # check S3 connection...
+        s3_manager.bucket_exsist()
+        metadata = s3_manager.download_metadata()
+        if metadata is None:
+            raise ValueError(f"Metadata file not found on S3 enpoint s3://{s3uri.bucket}/{s3uri.object}")
         if not os.path.isdir(self._args.target):
             try:
                 os.makedirs(self._args.target)
@@ -74,45 +410,65 @@ class Action():
                 raise SystemExit(f"Creation of the directory {self._args.target} failed - {ex}")
             else:
                 self._logger.info(f"Created download directory {self._args.target}")
-        futures = {}
-        downloaded = []
-        s3_manager = s3split.s3util.S3Manager(self._args.s3_access_key, self._args.s3_secret_key, self._args.s3_endpoint,
-                                              self._args.s3_verify_certificate, s3uri.bucket, s3uri.object, None)
-        # check S3 connection...
-        s3_manager.bucket_exsist()
-        metadata = s3_manager.download_metadata()
-        with tempfile.TemporaryDirectory() as tmpdir:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self._args.threads) as executor:
-                splits = metadata.get("splits")
-                tars = {tar.get('name'): tar.get('size') for tar in metadata.get("tars")}
-                ids = s3split.common.split_searh_file(splits, self._args.prefix)
-
-                # for tar in metadata["tars"]:
-                #     future = executor.submit(_run_download, tmpdir, tar['name'], tar['size'], s3uri, stats.update)
-                #     futures.update({future: tar['name']})
-                if ids is not None and len(ids) > 0:
-                    stats = s3split.stats.Stats(self._args.stats_interval, len(metadata['splits']), sum(c.get('size') for c in metadata.get('splits')))
-                    for id in ids:
-                        future = executor.submit(_run_download, tmpdir, s3split.common.gen_file_name(id), tars.get(s3split.common.gen_file_name(id)), s3uri, stats.update)
-                        futures.update({future: s3split.common.gen_file_name(id)})
-                    self._logger.debug(f"List of futures: {futures}")
-                    for future in concurrent.futures.as_completed(futures):
-                        try:
-                            data = future.result()
-                            downloaded.append(data)
-                            self._logger.debug(f"(future) completed - data: {data}")
-                        except Exception as exc:  # pylint: disable=broad-except
-                            self._logger.error(f"(future) generated an exception: {exc}")
-                            traceback_str = traceback.format_exc(exc)
-                            self._logger.error(f"(future) generated an exception: {traceback_str}")
-                    stats.print()
-                else:
-                    self._logger.info(f"No split id selected")
+        prefix = self._args.prefix.strip('/') if self._args.prefix is not None else None
+        journal = s3split.journal.DownloadJournal(self._args.target, f"s3://{s3uri.bucket}/{s3uri.object}", metadata.get('date'),
+                                                  self._args.resume)
+        cache = None
+        etags = {}
+        splits = metadata.get("splits")
+        segments = {s3split.common.gen_file_name(split.get('id')): split.get('segments') for split in splits}
+        # Originals of duplicates in prefix are extracted even outside prefix
+        originals = s3split.common.split_originals(splits, prefix) if prefix is not None else set()
+        tars = {tar.get('name'): tar for tar in metadata.get("tars") if tar is not None}
+        if self._args.cache_dir is not None:
+            cache = s3split.cache.TarCache(self._args.cache_dir, self._args.cache_size * 1024 * 1024)
+            objects = self._list_tars(metadata, s3uri)
+            for name, tar in tars.items():
+                endpoint, location_uri = self._location(tar, s3uri)
+                obj = objects.get((endpoint, location_uri.bucket, os.path.join(location_uri.object, name)))
+                etags[name] = obj['ETag'] if obj is not None else None
+        ids = s3split.common.split_searh_file(splits, self._args.prefix)
+        selected = set(ids or [])
+        completed = [id for id in ids or [] if journal.completed(s3split.common.gen_file_name(id), prefix)]
+        if len(completed) > 0:
+            # Resume: tars already extracted are skipped, partial tars are extracted again
+            self._logger.info(f"Resume download: {len(completed)} tar(s) already extracted are skipped")
+            ids = [id for id in ids if id not in completed]
+        if ids is None or len(ids) == 0:
+            self._logger.info(f"No split id selected")
+            self._restore_duplicates(splits, selected, None)
+            journal.close(remove=True)
+            return self._result(True)
+        # Largest tars first, round robin between locations of striped tars: all endpoints are busy from the start
+        costs = {split.get('id'): s3split.schedule.split_cost(split) for split in splits}
+        ids = s3split.schedule.lpt_order(sorted(ids), costs.get)
+        ids = s3split.common.interleave(ids, lambda id: self._location(tars.get(s3split.common.gen_file_name(id)), s3uri)[0])
+        stats = s3split.stats.Stats(self._args.stats_interval, len(metadata['splits']), sum(c.get('size') for c in metadata.get('splits')))
+        if len(completed) > 0:
+            stats.set("Skipped tars (resume)", len(completed))
+        downloaded, failed, restored = [], None, False
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with self._executor_pool(stats) as executor:
+                    names = (s3split.common.gen_file_name(id) for id in ids)
+                    downloaded, failed = self._map(executor, _run_download,
+                                                   ((tmpdir, name, tars.get(name), etags.get(name), s3uri, stats, cache,
+                                                     segments.get(name), journal) for name in names),
+                                                   lambda item: item[1], stats)
+            if failed == [] and not self._event.is_set() and None not in downloaded:
+                # Originals of duplicates may be segments written by several tars: restore when every tar is extracted
+                self._restore_duplicates(splits, selected, stats)
+                restored = True
+        finally:
+            # Keep the journal to resume an interrupted or failed download
+            journal.close(remove=restored)
+        stats.print()
+        return self._result(True, downloaded, failed, stats)
 
     def upload(self):
         """upload splits to s3"""
-        def _run_upload(split, s3uri, stats_cb):
-            """create a tar and upload"""
+        def _run_upload(split, s3uri, stats, multipart_state, location):
+            """create a tar and upload, location is None for tars stored with metadata"""
             def tar_filter(tobj):
                 # Add a container path if someone open the archive on a desktop
                 new = tobj.name.replace(self._args.source.strip('/'), 's3split').strip('/')
@@ -120,42 +476,67 @@ class Action():
                 return tobj
 
             name_tar = s3split.common.gen_file_name(split.get('id'))
+            prefix = s3split.common.key_prefix(name_tar, self._args.key_prefixes)
             self._logger.debug(f"(future) start archive/upload for tar {name_tar}")
-            s3manager = s3split.s3util.S3Manager(self._args.s3_access_key, self._args.s3_secret_key, self._args.s3_endpoint,
-                                                 self._args.s3_verify_certificate, s3uri.bucket, s3uri.object, stats_cb)
+            endpoint, s3uri = self._location({'location': location, 'prefix': prefix}, s3uri)
+            s3manager = self._s3_manager(s3uri, stats, multipart_state, endpoint)
             # Filter function to update tar path, required to untar in a safe location
             with tempfile.TemporaryDirectory() as tmpdir:
                 tar_file = os.path.join(tmpdir, name_tar)
                 # Start tar
                 if not self._event.is_set():
                     self._logger.info(f"{name_tar} archive creating... ")
+                    time_start = time.time()
                     with tarfile.open(tar_file, "w") as tar:
                         for path in split.get('paths'):
                             # remove base path from folder with filter function
                             tar.add(os.path.join(self._args.source, path), filter=tar_filter)
+                        for segment in split.get('segments', []):
+                            # Segment of a huge file: a member with only length bytes read from offset
+                            fs_path = os.path.join(self._args.source, segment['path'])
+                            tarinfo = tar.gettarinfo(fs_path, os.path.join('s3split', s3split.common.segment_name(segment['path'], segment['offset'])))
+                            tarinfo.size = segment['length']
+                            with open(fs_path, 'rb') as file:
+                                # Segments of a file changed since planning do not rebuild it: fail the tar
+                                size = os.fstat(file.fileno()).st_size
+                                if size != segment['size']:
+                                    raise ValueError(f"{segment['path']} changed size since planning: {segment['size']} bytes planned, "
+                                                     f"{size} bytes found")
+                                file.seek(segment['offset'])
+                                tar.addfile(tarinfo, file)
                         tar.close()
                     self._logger.info(f"{name_tar} archive completed")
+                    self._emit("tar_built", name=name_tar, files=len(split.get('paths')) + len(split.get('segments', [])),
+                               bytes=os.path.getsize(tar_file), duration=round(time.time() - time_start, 3))
                 # Start upload
                 if self._event.is_set():
                     self._logger.warning(f"{name_tar} - archive/upload interrupted because Ctrl + C was pressed!")
                     return None
                 self._logger.info(f"{name_tar} uploading... ")
-                s3manager.upload_file(tar_file)
+                self._track("upload", name_tar, os.path.getsize(tar_file), s3manager.upload_file, tar_file)
                 self._logger.info(f"{name_tar} upload completed")
                 self._logger.info(f"Active threads: {threading.active_count()}")
-                return {"name": os.path.basename(tar_file),
-                        "id": split.get('id'), "size": os.path.getsize(tar_file)}
+                tar_metadata = {"name": os.path.basename(tar_file), "id": split.get('id'), "size": os.path.getsize(tar_file)}
+                if location is not None:
+                    tar_metadata["location"] = location
+                if prefix is not None:
+                    tar_metadata["prefix"] = prefix
+                return tar_metadata
 
         # --- --- ---
         if not os.path.isdir(self._args.source):
             raise ValueError(f"upload source: '{self._args.source}' is not a directory")
+        # Options are checked before the placeholder metadata is written to the target
+        if self._args.target_weight <= 0:
+            raise ValueError("upload --target-weight must be positive")
+        if self._args.key_prefixes < 0:
+            raise ValueError("upload --key-prefixes must be positive or 0")
         self._logger.info(f"Tar object max size: {self._args.tar_size} MB")
         self._logger.info(f"Print stats evry: {self._args.stats_interval} seconds")
         if self._args.description is None or len(self._args.description) == 0:
             self._logger.warning(f"No description provided!!! Please use upload -d 'description' ... ")
         s3uri = s3split.s3util.S3Uri(self._args.target)
-        s3_manager = s3split.s3util.S3Manager(self._args.s3_access_key, self._args.s3_secret_key, self._args.s3_endpoint,
-                                              self._args.s3_verify_certificate, s3uri.bucket, s3uri.object, None)
+        s3_manager = self._s3_manager(s3uri)
         s3_manager.bucket_exsist()
         # Check if bucket is empty and if a metadata file is present
         objects = s3_manager.list_bucket_objects()
@@ -166,59 +547,182 @@ class Action():
                 self._logger.warning("Remote S3 bucket contains a metadata file!")
                 # TODO: If there is a remote metadata? exit and force user to clean bucket?
         # Upload metadata file
-        splits = s3split.common.split_file_by_size(self._args.source, self._args.tar_size * 1024 * 1024)
+        threads = self._args.threads_max if self._args.threads == "auto" else self._args.threads
+        splits = s3split.common.split_file_by_size(self._args.source, self._args.tar_size * 1024 * 1024, self._args.scan_cache,
+                                                   self._args.dedup, threads)
         # self._logger.debug(f"Splits: {splits}")
         stats = s3split.stats.Stats(self._args.stats_interval, len(splits), sum(c.get('size') for c in splits))
-        tars_uploaded = []
-        future_split = {}
+        self._emit("planned", splits=len(splits), bytes=sum(c.get('size') for c in splits),
+                   files=sum(s3split.common.split_files(c) for c in splits))
+        multipart_state = None
+        if self._args.multipart_state is not None:
+            multipart_state = s3split.s3util.MultipartState(self._args.multipart_state)
         if not s3_manager.upload_metadata(splits, None, self._args.description):
             self._logger.error("Metadata json file upload failed!")
             raise SystemExit
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self._args.threads) as executor:
-            for split in splits:
-                future = executor.submit(_run_upload, split, s3uri, stats.update)
-                future_split.update({future: split.get('id')})
-            self._logger.debug(f"List of futures: {future_split}")
-            for future in concurrent.futures.as_completed(future_split):
-                try:
-                    data = future.result()
-                    tars_uploaded.append(data)
-                    self._logger.debug(f"(future) completed - data: {data}")
-                except Exception as exc:  # pylint: disable=broad-except
-                    self._logger.error(f"Future generated an exception: {exc}")
-                    traceback_str = traceback.format_exc(exc)
-                    self._logger.error(f"Future generated an exception: {traceback_str}")
+        # Stripes: first target is the upload target (with metadata), tars are spread by bytes proportionally to weights
+        targets = [{'endpoint': self._args.s3_endpoint, 'bucket': s3uri.bucket, 'path': s3uri.object,
+                    'weight': self._args.target_weight}] + (self._args.stripe or [])
+        locations = [None] + [{key: target[key] for key in ('endpoint', 'bucket', 'path')} for target in targets[1:]]
+        stripe_managers = [s3_manager]
+        for location in locations[1:]:
+            endpoint, location_uri = self._location({'location': location}, s3uri)
+            stripe_manager = self._s3_manager(location_uri, endpoint=endpoint)
+            stripe_manager.create_bucket()
+            stripe_managers.append(stripe_manager)
+        stripes = s3split.common.assign_stripes(splits, [target['weight'] for target in targets])
+        if len(targets) > 1:
+            for index, target in enumerate(targets):
+                self._logger.info(f"Stripe {target['endpoint']} s3://{target['bucket']}/{target['path']}: "
+                                  f"{stripes.count(index)} tars")
+        with self._executor_pool(stats) as executor:
+            # Largest splits first: a big tar does not start last and run alone at the end
+            order = s3split.schedule.lpt_order(zip(splits, stripes), lambda item: s3split.schedule.split_cost(item[0]))
+            tars_uploaded, failed = self._map(executor, _run_upload,
+                                              ((split, s3uri, stats, multipart_state, locations[stripe]) for split, stripe in order),
+                                              lambda item: s3split.common.gen_file_name(item[0].get('id')), stats)
         if not s3_manager.upload_metadata(splits, tars_uploaded, self._args.description):
             raise SystemExit("Metadata json file upload failed!")
+        # Interrupted uploads saved in multipart state are kept to be resumed by a new run
+        for stripe_manager in stripe_managers:
+            stripe_manager.abort_multipart_uploads(multipart_state.upload_ids() if multipart_state is not None else None)
+        stats.print()
+        return self._result(True, tars_uploaded, failed, stats)
+
+    def repack(self):
+        """rebuild dataset tars with a new tar size server side: tar members are copied as byte ranges of source tars"""
+        def _run_index(s3_manager, name, size):
+            self._logger.info(f"{name} reading tar index...")
+            return name, s3_manager.tar_members(name, size)
+
+        def _run_compose(split, pieces, stats):
+            name = s3split.common.gen_file_name(split.get('id'))
+            prefix = s3split.common.key_prefix(name, self._args.key_prefixes)
+            if self._event.is_set():
+                self._logger.warning(f"{name} - repack interrupted because Ctrl + C was pressed!")
+                return None
+            self._logger.info(f"{name} composing from {len(pieces) - 1} source range(s)...")
+            _, target_uri = self._location({'prefix': prefix}, target)
+            size = self._track("repack", name, None, self._s3_manager(target_uri, stats).compose_object, name, pieces, source.bucket)
+            self._logger.info(f"{name} repack completed")
+            tar = {"name": name, "id": split.get('id'), "size": size}
+            if prefix is not None:
+                tar["prefix"] = prefix
+            return tar
+
+        # --- --- ---
+        source = s3split.s3util.S3Uri(self._args.source)
+        target = s3split.s3util.S3Uri(self._args.target)
+        if (source.bucket, source.object.strip('/')) == (target.bucket, target.object.strip('/')):
+            raise ValueError("repack target must be different from source")
+        if self._args.key_prefixes < 0:
+            raise ValueError("repack --key-prefixes must be positive or 0")
+        source_manager = self._s3_manager(source)
+        target_manager = self._s3_manager(target)
+        if target_manager.bucket_exsist() and target_manager.download_metadata() is not None:
+            raise ValueError(f"repack target s3://{target.bucket}/{target.object} already contains a dataset")
+        metadata = source_manager.download_metadata()
+        if metadata is None:
+            raise ValueError(f"Metadata file not found on S3 enpoint s3://{source.bucket}/{source.object}")
+        if any(tar.get('location') is not None for tar in metadata.get('tars') if tar is not None):
+            raise ValueError("repack of a striped dataset is not supported: server side copy works only inside an endpoint")
+        source_tars = {tar.get('name'): tar for tar in metadata.get('tars') if tar is not None}
+        tars = {name: tar.get('size') for name, tar in source_tars.items()}
+        # Read only tar headers of source tars to get member byte ranges
+        indexes = {}
+        with self._executor_pool() as executor:
+            futures = {}
+            for split in metadata.get('splits'):
+                name = s3split.common.gen_file_name(split.get('id'))
+                _, location_uri = self._location(source_tars.get(name), source)
+                futures.update({self._submit(executor, _run_index, self._s3_manager(location_uri), name, tars.get(name)): name})
+            results, failed = self._wait(futures)
+        if len(failed) > 0:
+            raise ValueError(f"Reading tar index failed for {len(failed)} tar(s): {', '.join(sorted(failed))}")
+        indexes.update(results)
+        # Group members in new splits, contiguous members of the same source tar become a single range
+        max_size = self._args.tar_size * 1024 * 1024
+        splits = []
+        pieces = {}
+
+        def _next_split():
+            splits.append({'paths': [], 'size': 0, 'id': len(splits) + 1})
+            pieces[len(splits)] = []
+        _next_split()
+        for split in metadata.get('splits'):
+            name = s3split.common.gen_file_name(split.get('id'))
+            key = os.path.join(self._location(source_tars.get(name), source)[1].object, name)
+            # Segments of huge files are copied as they are, their tar member name is kept
+            segments = {os.path.join('s3split', s3split.common.segment_name(segment['path'], segment['offset'])): segment
+                        for segment in split.get('segments', [])}
+            duplicates = split.get('duplicates') or {}
+            for tarinfo, start, end in indexes[name]:
+                # A symbolic link is only a header: copied like files. A hard link needs its target in the same tar
+                if not tarinfo.isreg() and not tarinfo.issym():
+                    raise ValueError(f"repack of {tarinfo.name} in {name} is not supported: only files and symbolic links are copied")
+                if splits[-1]['size'] > 0 and splits[-1]['size'] + tarinfo.size > max_size:
+                    _next_split()
+                if tarinfo.name in segments:
+                    path = segments[tarinfo.name]['path'] if segments[tarinfo.name]['offset'] == 0 else None
+                    splits[-1].setdefault('segments', []).append(segments[tarinfo.name])
+                else:
+                    path = tarinfo.name.replace('s3split', '').strip('/')
+                    splits[-1]['paths'].append(path)
+                # Duplicates follow their original (first segment of a segmented original)
+                if path in duplicates:
+                    splits[-1].setdefault('duplicates', {})[path] = duplicates[path]
+                splits[-1]['size'] += tarinfo.size
+                last = pieces[len(splits)][-1] if len(pieces[len(splits)]) > 0 else None
+                if last is not None and last[0] == key and last[2] == start:
+                    pieces[len(splits)][-1] = (key, last[1], end)
+                else:
+                    pieces[len(splits)].append((key, start, end))
+        for split in splits:
+            # End of archive: two zero blocks
+            pieces[split.get('id')].append(b"\0" * tarfile.BLOCKSIZE * 2)
+        self._logger.info(f"Repack {len(metadata.get('splits'))} tar(s) in {len(splits)} tar(s) of max size {self._args.tar_size} MB")
+        self._emit("planned", splits=len(splits), bytes=sum(c.get('size') for c in splits), files=sum(s3split.common.split_files(c) for c in splits))
+        stats = s3split.stats.Stats(self._args.stats_interval, len(splits), sum(tars.values()))
+        with self._executor_pool(stats) as executor:
+            tars_repacked, failed = self._map(executor, _run_compose,
+                                              ((split, pieces[split.get('id')], stats) for split in s3split.schedule.lpt_order(splits, s3split.schedule.split_cost)),
+                                              lambda item: s3split.common.gen_file_name(item[0].get('id')), stats)
         stats.print()
+        if len(failed) > 0 or None in tars_repacked:
+            raise ValueError(f"Repack failed for {len(failed)} tar(s), new metadata not written: {', '.join(sorted(failed))}")
+        # Metadata is written last with a single put: target dataset is visible only when all tars are present
+        if not target_manager.upload_metadata(splits, tars_repacked, metadata.get('description')):
+            raise SystemExit("Metadata json file upload failed!")
+        return self._result(True, tars_repacked, failed, stats)
 
     def check(self, s3uri):
         """download splits to s3"""
         self._logger.info(f"Check S3 - Compare S3 metadata info (tar name and size) with remote S3 object")
-        s3_manager = s3split.s3util.S3Manager(self._args.s3_access_key, self._args.s3_secret_key, self._args.s3_endpoint,
-                                              self._args.s3_verify_certificate, s3uri.bucket, s3uri.object, None)
+        s3_manager = self._s3_manager(s3uri)
         metadata = s3_manager.download_metadata()
         self._logger.info(f"Metadata from S3:\n{pformat(metadata)}")
         errors = False
         if metadata is None:
             self._logger.info(f"Metadata file not found on S3 enpoint s3://{s3uri.bucket}/{s3uri.object}")
             return True
-        metadata_tar = {tar['name']: tar['size'] for tar in metadata.get("tars") if tar is not None}
-        s3objects = s3_manager.list_bucket_objects()
-        s3_data = {obj['Key']: obj['Size'] for obj in s3objects}
+        tars = {tar['name']: tar for tar in metadata.get("tars") if tar is not None}
+        metadata_tar = {name: tar['size'] for name, tar in tars.items()}
+        s3_data = {key: obj['Size'] for key, obj in self._list_tars(metadata, s3uri).items()}
         for split in metadata.get("splits"):
             if split is None:
                 errors = True
                 self._logger.error(f"Metadata file is corrupted! Split array is incomplete!")
             else:
-                key = os.path.join(s3uri.object, s3split.common.gen_file_name(split.get('id')))
+                endpoint, location_uri = self._location(tars.get(s3split.common.gen_file_name(split.get('id'))), s3uri)
+                key = os.path.join(location_uri.object, s3split.common.gen_file_name(split.get('id')))
+                s3_size = s3_data.get((endpoint, location_uri.bucket, key))
                 # self._logger.info(f"S3 size: {s3_data.get(key)}, Tar size: {metadata_tar.get(s3split.common.gen_file_name(split.get('id')))}")
-                if s3_data.get(key) is None:
+                if s3_size is None:
                     self._logger.error(f"Split part {key} not found on S3! Inclomplete uploads detected!")
                     errors = True
-                elif s3_data.get(key) != metadata_tar.get(s3split.common.gen_file_name(split.get('id'))):
+                elif s3_size != metadata_tar.get(s3split.common.gen_file_name(split.get('id'))):
                     errors = True
-                    self._logger.error(f"Check size for split part {key} failed! Expected size: {split.get('size')} comparade to s3 object size: {s3_data.get(key)} ")
+                    self._logger.error(f"Check size for split part {key} failed! Expected size: {split.get('size')} comparade to s3 object size: {s3_size} ")
                 else:
                     self._logger.debug(f"Check size for split part {key}: OK")
         if not errors:
@@ -0,0 +1,158 @@
+"""library API: run s3split jobs from a long running process, S3 clients and threads are reused across jobs"""
+import argparse
+import threading
+import concurrent.futures
+import s3split.common
+import s3split.s3util
+import s3split.actions
+import s3split.schedule
+import s3split.storage
+import s3split.main
+import s3split.dryrun
+
+
+def _defaults():
+    """defaults of command line options from the cli parser, read when a config is created (env variables included)
+
+    Return {'common': {option: default}, command: {option: default}}, positional arguments are not options.
+    """
+    parser = s3split.main.build_parser()
+    common = [action.dest for action in parser._actions if action.option_strings and action.dest != 'help']  # pylint: disable=protected-access
+    commands = next(action for action in parser._actions if isinstance(action, argparse._SubParsersAction)).choices  # pylint: disable=protected-access
+    defaults = {}
+    for command, subparser in commands.items():
+        positionals = [action.dest for action in subparser._actions if not action.option_strings]  # pylint: disable=protected-access
+        # Parsing placeholders applies option types to defaults (env variables are strings)
+        options = vars(parser.parse_args([command] + ["-"] * len(positionals)))
+        defaults['common'] = {key: options[key] for key in common}
+        defaults[command] = {key: value for key, value in options.items() if key not in common + positionals + ['command']}
+    return defaults
+
+
+class Config():
+    """Options of s3split jobs: same names and defaults of command line options (--tar-size is tar_size)"""
+
+    def __init__(self, **options):
+        self._defaults = _defaults()
+        self.options = dict(self._defaults['common'])
+        self.options.update(self._validate(options, self._defaults['common']))
+        local = s3split.storage.is_local(self.options.get('s3_endpoint'))
+        for key in ['s3_endpoint'] if local else ['s3_secret_key', 's3_access_key', 's3_endpoint']:
+            if self.options.get(key) is None:
+                raise ValueError(f"Error! option {key} or env variables {key.upper()} is required")
+
+    @staticmethod
+    def _validate(options, allowed):
+        unknown = sorted(set(options) - set(allowed))
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown option(s): {', '.join(unknown)}")
+        return options
+
+    def args(self, command, **options):
+        """namespace for a command, same as parsed command line arguments"""
+        if command not in self._defaults or command == 'common':
+            raise ValueError(f"Unknown command {command}")
+        args = dict(self.options)
+        args.update(self._defaults[command])
+        args.update(self._validate(options, list(self._defaults[command]) + ['source', 'target']))
+        if args.get('stripe') is not None:
+            args['stripe'] = [s3split.common.parse_stripe(stripe) if isinstance(stripe, str) else stripe for stripe in args['stripe']]
+        return argparse.Namespace(command=command, **args)
+
+
+class Result():
+    """Outcome of a job
+
+    :ivar ok: True if every tar was transferred (and check passed), False for an interrupted job
+    :ivar tars: metadata of transferred tars (name, id, size) for upload/repack, tar names for download
+    :ivar failed: names of failed tars
+    :ivar stats: final stats snapshot (bytes, tars, elapsed time and counters)
+    :ivar interrupted: True if the job was stopped (event set) before every tar was transferred
+    :ivar estimate: plan and time estimate of an upload dry_run (tars, files, bytes, requests, seconds), None otherwise
+    """
+
+    def __init__(self, command, ok, tars, failed, stats, interrupted=False, estimate=None):
+        self.command = command
+        self.ok = ok
+        self.tars = tars
+        self.failed = failed
+        self.stats = stats
+        self.interrupted = interrupted
+        self.estimate = estimate
+
+    def __repr__(self):
+        return f"Result(command={self.command!r}, ok={self.ok}, tars={len(self.tars)}, failed={self.failed}, interrupted={self.interrupted})"
+
+
+class Session():
+    """S3 client pool, thread pool and multipart part pool shared by jobs, close it (or use `with`) when the process does not need it anymore
+
+    Jobs of a session can run at the same time from different threads, their tars share the thread pool.
+    """
+
+    def __init__(self, config=None, **options):
+        self.config = config if config is not None else Config(**options)
+        threads = self.config.options['threads_max'] if self.config.options['threads'] == "auto" else self.config.options['threads']
+        self.client_pool = s3split.s3util.ClientPool(threads * s3split.common.MULTIPART_CONCURRENCY)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="s3split")
+        self.part_pool = s3split.schedule.PartPool(threads * s3split.common.MULTIPART_CONCURRENCY)
+
+    def run(self, command, cb_progress=None, event=None, **options):
+        """run a command (upload, download, repack, check) and return a Result, failed tars do not raise
+
+        An upload with dry_run plans tars and returns an estimate without touching S3 (unless probe).
+        """
+        args = self.config.args(command, **options)
+        if command == "upload" and args.dry_run:
+            return Result(command, True, [], [], None, estimate=s3split.dryrun.run_dry_run(args))
+        action = s3split.actions.Action(args, event if event is not None else threading.Event(),
+                                        self.client_pool, self.executor, cb_progress, self.part_pool)
+        return Result(**action.run(raise_on_failure=False))
+
+    def close(self):
+        """wait running jobs and release threads"""
+        self.executor.shutdown(wait=True)
+        self.part_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Job():
+    def __init__(self, session=None, **options):
+        self._own_session = session is None
+        self.session = session if session is not None else Session(**options)
+
+    def close(self):
+        """close the session if created by this object"""
+        if self._own_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Uploader(_Job):
+    """Upload local directories as s3split datasets, use a shared `session` or pass Config options"""
+
+    def upload(self, source, target, cb_progress=None, event=None, **options):
+        """upload source directory to target s3://bucket/path, options: tar_size, description, stripe, ..."""
+        return self.session.run("upload", cb_progress, event, source=source, target=target, **options)
+
+
+class Downloader(_Job):
+    """Download s3split datasets, use a shared `session` or pass Config options"""
+
+    def download(self, source, target, cb_progress=None, event=None, **options):
+        """download dataset source s3://bucket/path to a new target directory, options: prefix, cache_dir, ..."""
+        return self.session.run("download", cb_progress, event, source=source, target=target, **options)
+
+    def check(self, target):
+        """compare dataset metadata with remote objects"""
+        return self.session.run("check", target=target)
@@ -0,0 +1,97 @@
+"""local tar cache: size bounded LRU shared between s3split processes"""
+import os
+import fcntl
+import hashlib
+import threading
+import contextlib
+import s3split.common
+
+
+class TarCache():
+    """On disk cache of downloaded tars keyed by bucket, path, tar name and ETag
+
+    Entries are written to a temporary file and renamed in place, every cache update runs under
+    an exclusive file lock so different processes (and threads) can share the same cache directory.
+    Least recently used entries are evicted when the cache grows over `max_size` bytes.
+    """
+    _SUFFIX = ".tar"
+
+    def __init__(self, path, max_size):
+        self._logger = s3split.common.get_logger()
+        self._path = path
+        self._max_size = max_size
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as ex:
+            raise ValueError(f"Creation of cache directory {path} failed - {ex}")
+        self._lock_path = os.path.join(path, ".lock")
+
+    @staticmethod
+    def key(bucket, path, name, etag):
+        """cache key for a remote tar"""
+        return hashlib.sha256(f"{bucket}/{path}/{name}:{etag}".encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self._path, key + self._SUFFIX)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # A new open file description for every lock: flock excludes threads and processes
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _open_entry(self, key):
+        """open an entry and mark it as recently used, an open file survives a concurrent eviction"""
+        try:
+            file = open(self._entry(key), 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(self._entry(key))
+        return file
+
+    def _evict(self, size):
+        """remove least recently used entries until size bytes fit in cache, return evicted bytes"""
+        entries = []
+        for entry in os.scandir(self._path):
+            if entry.name.endswith(self._SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(entry[1] for entry in entries)
+        evicted = 0
+        for _, entry_size, path in sorted(entries):
+            if total + size <= self._max_size:
+                break
+            os.remove(path)
+            total -= entry_size
+            evicted += entry_size
+            self._logger.debug(f"Cache evicted {path}")
+        return evicted
+
+    def open(self, key, size, fetch):
+        """return (file, hit, evicted bytes), on miss fetch(file) writes the tar in cache
+
+        Tars bigger than the whole cache are fetched in a temporary file and never cached.
+        """
+        with self._locked():
+            file = self._open_entry(key)
+        if file is not None:
+            return file, True, 0
+        tmp_path = os.path.join(self._path, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as tmp:
+                fetch(tmp)
+            if size > self._max_size:
+                file = open(tmp_path, 'rb')
+                return file, False, 0
+            with self._locked():
+                evicted = self._evict(size)
+                os.replace(tmp_path, self._entry(key))
+                file = self._open_entry(key)
+            return file, False, evicted
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
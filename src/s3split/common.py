@@ -1,7 +1,18 @@
-"""common functions: logging, split files"""
+"""common functions: logging, split files, s3 uri"""
 import logging
 import random
+import hashlib
+import re
 import os
+import time
+import s3split.scan
+import s3split.plan
+import s3split.dedup
+
+# Multipart transfer config shared by S3 transfers and planning
+MULTIPART_THRESHOLD = 1024 * 1024 * 64
+MULTIPART_CHUNKSIZE = 1024 * 1024 * 64
+MULTIPART_CONCURRENCY = 8
 
 
 def get_logger():
@@ -10,11 +21,76 @@ def get_logger():
     return logging
 
 
+# From https://github.com/s3tools/s3cmd/blob/master/S3/S3Uri.py
+
+
+class S3Uri():
+    """Contain a s3 url s3://bucket/object"""
+    _re = re.compile("^s3:///*([^/]*)/?(.*)", re.IGNORECASE | re.UNICODE)
+
+    def __init__(self, string):
+        self.bucket = None
+        self.object = None
+        match = self._re.match(string)
+        if not match:
+            raise ValueError("%s: not a S3 URI" % string)
+        groups = match.groups()
+        self.bucket = groups[0]
+        self.object = groups[1]
+        if len(self.object) == 0:
+            raise SystemExit(f"S3 URI must contains bucket and path s3://bucket/path")
+
+
+def parse_stripe(value):
+    """parse a stripe target in the form ENDPOINT,s3://bucket/path[,WEIGHT]"""
+    parts = value.split(',')
+    if len(parts) not in (2, 3):
+        raise ValueError(f"stripe '{value}' must be in the form ENDPOINT,s3://bucket/path[,WEIGHT]")
+    s3uri = S3Uri(parts[1])
+    weight = float(parts[2]) if len(parts) == 3 else 1.0
+    if weight <= 0:
+        raise ValueError(f"stripe '{value}' weight must be positive")
+    return {'endpoint': parts[0], 'bucket': s3uri.bucket, 'path': s3uri.object, 'weight': weight}
+
+
+def assign_stripes(splits, weights):
+    """assign every split to a stripe index so that assigned bytes are proportional to stripe weights"""
+    assigned = [0] * len(weights)
+    stripes = []
+    for split in splits:
+        index = min(range(len(weights)), key=lambda i: (assigned[i] + split.get('size')) / weights[i])
+        assigned[index] += split.get('size')
+        stripes.append(index)
+    return stripes
+
+
+def interleave(items, key):
+    """round robin items between groups defined by key, preserving order inside a group"""
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    queues = list(groups.values())
+    result = []
+    while queues:
+        for queue in queues:
+            result.append(queue.pop(0))
+        queues = [queue for queue in queues if len(queue) > 0]
+    return result
+
+
 def gen_file_name(split_id):
     """generate split tar filename"""
     return f"s3split-part-{split_id}.tar"
 
 
+def key_prefix(name, prefixes):
+    """hashed sub-prefix of a tar name, fixed width hex in [0, prefixes): consecutive tars land on different key ranges"""
+    if prefixes is None or prefixes <= 1:
+        return None
+    width = len(f"{prefixes - 1:x}")
+    return f"{int(hashlib.md5(name.encode('utf-8')).hexdigest()[:8], 16) % prefixes:0{width}x}"
+
+
 def sizeof_fmt(num, suffix='B'):
     for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
         if abs(num) < 1024.0:
@@ -44,37 +120,109 @@ def count_path_depth(path):
     return len(path.strip('/').split('/'))
 
 
-def split_file_by_size(path, max_size):
+def segment_name(path, offset):
+    """tar member name of a file segment"""
+    return f"{path}.s3split-segment-{offset}"
+
+
+def split_file_by_size(path, max_size, scan_cache=None, dedup=False, threads=8):
+    """split files in a plan.Plan of splits with a maximum total size, scan_cache is an optional path of a persistent scan cache
+
+    Files bigger than max_size are cut in segments of max_size bytes spread across splits: a split lists them in
+    'segments' with path, offset, length and the whole file size.
+    With dedup identical files are stored once: the split of the original (of its first segment) maps its path
+    to the paths of duplicates in 'duplicates'.
+    """
     LOGGER = get_logger()
-    base_path = path
+    base_path = os.path.abspath(path)
     base_depth = count_path_depth(path)
     LOGGER.info(f"path: {path}, base depth: {base_depth}")
-    splits = []
-    split_id = 1
+    plan = s3split.plan.Plan()
     split_size = 0
-    split_paths = []
+    split_segments = []
+    split_duplicates = {}
 
     def _next_split():
-        nonlocal splits, split_id, split_paths, split_size
-        splits.append({'paths': split_paths, 'size': split_size, 'id': split_id})
+        nonlocal split_size, split_segments, split_duplicates
+        plan.add_split(split_size, split_segments, split_duplicates)
         split_size = 0
-        split_paths = []
-        split_id += 1
+        split_segments = []
+        split_duplicates = {}
 
-    for dirpath, dirnames, filenames in os.walk(path):
-        depth = count_path_depth(dirpath) - base_depth
-        # LOGGER.info(f"path: {dirpath}, dirname:{dirnames}, filenames:{filenames}, depth: {depth}")
-        for file in filenames:
-            size = os.path.getsize(os.path.join(dirpath, file))
+    def _scan():
+        for dirpath, files in s3split.scan.scan_tree(base_path, cache):
+            reldir = os.path.relpath(dirpath, base_path)
+            yield '' if reldir == '.' else reldir, files
+
+    def _dedup(entries):
+        # Whole scan in a compact catalog: duplicates are known before the first split is cut
+        catalog = s3split.plan.Plan()
+        for reldir, files in entries:
+            directory = catalog.directory(reldir)
+            for file, size in files:
+                catalog.add_file(directory, file, size)
+        duplicates = s3split.dedup.find_duplicates(base_path, catalog, threads)
+        copies = {}
+        for index, original in sorted(duplicates.items()):
+            copies.setdefault(original, []).append(catalog.path(index))
+        for index in range(catalog.files):
+            if index not in duplicates:
+                reldir, file = os.path.split(catalog.path(index))
+                yield reldir, [(file, catalog.size(index))], copies.get(index)
+
+    time_start = time.time()
+    cache = s3split.scan.ScanCache(scan_cache) if scan_cache is not None else None
+    if dedup:
+        entries = _dedup(_scan())
+    else:
+        entries = ((reldir, files, None) for reldir, files in _scan())
+    for reldir, files, copies in entries:
+        directory = plan.directory(reldir)
+        for file, size in files:
+            if size > max_size:
+                # A huge file is not serialized on a single tar: segments are uploaded and reassembled in parallel
+                relpath = os.path.join(reldir, file)
+                for offset in range(0, size, max_size):
+                    length = min(max_size, size - offset)
+                    if split_size > 0 and length + split_size > max_size:
+                        _next_split()
+                    if offset == 0 and copies:
+                        split_duplicates[relpath] = copies
+                    split_segments.append({'path': relpath, 'offset': offset, 'length': length, 'size': size})
+                    split_size += length
+                continue
             if size + split_size > max_size:
                 # LOGGER.info("=== SPLIT SIZE")
                 _next_split()
-            split_paths.append(os.path.relpath(os.path.join(dirpath, file), path))
+            if copies:
+                split_duplicates[os.path.join(reldir, file)] = copies
+            plan.add_file(directory, file, size)
             split_size += size
     _next_split()
-    from pprint import pformat
-    # LOGGER.info(pformat(splits))
-    return splits
+    if cache is not None:
+        cache.close(base_path)
+        LOGGER.info(f"Scan cache {scan_cache}: {cache.hits} unchanged directories, {cache.misses} directories read")
+    LOGGER.info(f"Scan time: {round(time.time() - time_start, 1)} seconds")
+    return plan
+
+
+def split_files(split):
+    """number of tar members of a split (plan split or metadata dict): whole files and segments"""
+    if isinstance(split, s3split.plan.Split):
+        return split.files
+    return len(split.get('paths')) + len(split.get('segments', []))
+
+
+def split_paths(split):
+    """paths restored from a split: whole files, segmented files and duplicates of its files"""
+    return (split.get('paths') + [segment['path'] for segment in split.get('segments', [])] +
+            [copy for copies in (split.get('duplicates') or {}).values() for copy in copies])
+
+
+def split_originals(splits, prefix):
+    """paths of originals with a duplicate in prefix: they are restored even outside prefix"""
+    return {original for split in splits for original, copies in (split.get('duplicates') or {}).items()
+            if any(prefix.strip('/') in copy.strip('/') for copy in copies)}
 
 
 def split_searh_file(splits, prefix=None):
@@ -83,10 +231,14 @@ def split_searh_file(splits, prefix=None):
         for split in splits:
             ids.add(split.get('id'))
     else:
+        # Only the split of the first segment lists duplicates: every segment of their original is needed
+        originals = split_originals(splits, prefix)
         for split in splits:
-            for path in split.get('paths'):
+            for path in split_paths(split):
                 if prefix.strip('/') in path.strip('/'):
                     ids.add(split.get('id'))
+            if any(segment['path'] in originals for segment in split.get('segments', [])):
+                ids.add(split.get('id'))
     return list(ids)
     # list(dict.fromkeys(ids))
 
@@ -94,7 +246,7 @@ def split_searh_file(splits, prefix=None):
 def split_get_dirs(splits):
     folders = set()
     for split in splits:
-        for path in split.get('paths'):
+        for path in split_paths(split):
             base = os.path.dirname(path)
             if base is not None and len(base) > 0:
                 folders.add(base)
@@ -0,0 +1,210 @@
+"""streaming dataset: iterate tar members directly from S3 without local scratch space"""
+import os
+import queue
+import random
+import tarfile
+import threading
+import s3split.s3util
+import s3split.common
+
+
+def shard_tars(ids, shard_index=0, num_shards=1, shuffle=False, seed=0, epoch=0):
+    """return split ids assigned to a shard, all shards must use the same seed to get disjoint sets"""
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError(f"Invalid shard {shard_index} of {num_shards}")
+    ids = sorted(ids)
+    if shuffle:
+        random.Random(seed + epoch).shuffle(ids)
+    return ids[shard_index::num_shards]
+
+
+class PrefetchStream():
+    """file-like object filled by a background thread with a bounded queue of chunks"""
+    _EOF = object()
+
+    def __init__(self, body, chunk_size=1024 * 1024, max_chunks=8):
+        self._body = body
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._stop = threading.Event()
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                chunk = self._body.read(self._chunk_size)
+                if not chunk:
+                    break
+                if not self._put(chunk):
+                    return
+            self._put(self._EOF)
+        except Exception as exc:  # pylint: disable=broad-except
+            self._put(exc)
+
+    def read(self, size=-1):
+        """read up to size bytes, blocking until the background thread provides data"""
+        while not self._eof and (size < 0 or len(self._buffer) - self._pos < size):
+            item = self._queue.get()
+            if item is self._EOF:
+                self._eof = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self._buffer = self._buffer[self._pos:] + item
+                self._pos = 0
+        end = len(self._buffer) if size < 0 else self._pos + size
+        data = self._buffer[self._pos:end]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        """stop background thread and release the s3 body"""
+        self._stop.set()
+        self._thread.join()
+        self._body.close()
+
+
+class Dataset():
+    """Iterate (path, bytes) for every file stored in a s3split dataset, reading tars in stream order
+
+    Next `prefetch` tars are read in background, each one with a buffer of at most `buffer_size` bytes.
+    Use `shard_index`/`num_shards` to split tars between workers and `set_epoch` to reshuffle tar order.
+    A file bigger than the tar size (split in segments) is yielded with the tar of its first segment, other
+    segments are read with ranged gets: with `segments="skip"` these files are skipped instead.
+    """
+
+    def __init__(self, uri, s3_access_key=None, s3_secret_key=None, s3_endpoint=None, s3_verify_certificate=True,
+                 prefix=None, prefetch=2, buffer_size=64 * 1024 * 1024, shard_index=0, num_shards=1, shuffle=False, seed=0,
+                 segments="read"):
+        self._logger = s3split.common.get_logger()
+        if segments not in ("read", "skip"):
+            raise ValueError(f"Invalid segments '{segments}', use 'read' or 'skip'")
+        s3uri = s3split.s3util.S3Uri(uri)
+        self._credentials = (s3_access_key or os.environ.get('S3_ACCESS_KEY'), s3_secret_key or os.environ.get('S3_SECRET_KEY'))
+        self._s3_verify_certificate = s3_verify_certificate
+        self._base = (s3_endpoint or os.environ.get('S3_ENDPOINT'), s3uri.bucket, s3uri.object)
+        self._s3_manager = self._new_manager(*self._base)
+        metadata = self._s3_manager.download_metadata()
+        if metadata is None:
+            raise ValueError(f"Metadata file not found on s3://{s3uri.bucket}/{s3uri.object}")
+        # Striped tars are read from their own endpoint/bucket, tars with a hashed key prefix from a sub-prefix
+        self._tars = {tar.get('name'): tar for tar in metadata.get('tars') or [] if tar is not None}
+        self._stripe_managers = {}
+        # Segments of files bigger than tar size: {tar member name: (tar name, segment)}
+        self._segments = {os.path.join('s3split', s3split.common.segment_name(segment['path'], segment['offset'])):
+                          (s3split.common.gen_file_name(split.get('id')), segment)
+                          for split in metadata.get('splits') for segment in split.get('segments', [])}
+        self._read_segments = segments == "read"
+        if len(self._segments) > 0 and not self._read_segments:
+            self._logger.warning(f"Dataset contains {len(self._segments)} segments of huge files, they are skipped (segments='skip')")
+        self._indexes = {}
+        # Deduplicated datasets: content of an original is yielded again for every duplicate
+        self._duplicates = {original: copies for split in metadata.get('splits')
+                            for original, copies in (split.get('duplicates') or {}).items()}
+        self._prefix = prefix
+        self._ids = s3split.common.split_searh_file(metadata.get('splits'), prefix)
+        self._prefetch = prefetch
+        self._chunk_size = min(1024 * 1024, buffer_size)
+        self._max_chunks = max(1, buffer_size // self._chunk_size)
+        self._shard_index = shard_index
+        self._num_shards = num_shards
+        self._shuffle = shuffle
+        self._seed = seed
+        self._epoch = 0
+
+    def set_epoch(self, epoch):
+        """set epoch used to shuffle tar order"""
+        self._epoch = epoch
+
+    def tars(self):
+        """tar names read by this shard in the current epoch"""
+        ids = shard_tars(self._ids, self._shard_index, self._num_shards, self._shuffle, self._seed, self._epoch)
+        return [s3split.common.gen_file_name(split_id) for split_id in ids]
+
+    def _new_manager(self, endpoint, bucket, path):
+        return s3split.s3util.S3Manager(self._credentials[0], self._credentials[1], endpoint, self._s3_verify_certificate, bucket, path)
+
+    def _manager(self, name):
+        tar = self._tars.get(name) or {}
+        location, prefix = tar.get('location'), tar.get('prefix')
+        if location is None and prefix is None:
+            return self._s3_manager
+        endpoint, bucket, path = self._base if location is None else (location['endpoint'], location['bucket'], location['path'])
+        key = (endpoint, bucket, os.path.join(path, prefix) if prefix is not None else path)
+        if key not in self._stripe_managers:
+            self._stripe_managers[key] = self._new_manager(*key)
+        return self._stripe_managers[key]
+
+    def _open(self, name):
+        self._logger.debug(f"Dataset prefetch {name}")
+        return PrefetchStream(self._manager(name).open_object(name), self._chunk_size, self._max_chunks)
+
+    def __iter__(self):
+        names = self.tars()
+        streams = []
+        try:
+            while names or streams:
+                # keep current tar plus the next `prefetch` tars streaming in background
+                while names and len(streams) <= self._prefetch:
+                    name = names.pop(0)
+                    streams.append((name, self._open(name)))
+                name, stream = streams.pop(0)
+                try:
+                    yield from self._members(name, stream)
+                finally:
+                    stream.close()
+        finally:
+            for _, stream in streams:
+                stream.close()
+
+    def _members(self, name, stream):
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for tarinfo in tar:
+                segment = self._segments.get(tarinfo.name)
+                if not tarinfo.isfile() or segment is not None and (not self._read_segments or segment[1]['offset'] > 0):
+                    continue
+                # Remove container path added on upload
+                path = tarinfo.name.replace('s3split', '').strip('/') if segment is None else segment[1]['path']
+                paths = [path] + self._duplicates.get(path, [])
+                if self._prefix is not None:
+                    paths = [item for item in paths if self._prefix.strip('/') in item]
+                if len(paths) == 0:
+                    continue
+                content = tar.extractfile(tarinfo).read()
+                if segment is not None:
+                    content = self._read_file(path, content)
+                for item in paths:
+                    yield item, content
+        self._logger.debug(f"Dataset {name} completed")
+
+    def _read_file(self, path, first):
+        """content of a file split in segments: first segment data and other segments read from their tars"""
+        content = bytearray(first)
+        segments = [(segment['offset'], member, tar_name, segment['size']) for member, (tar_name, segment) in self._segments.items()
+                    if segment['path'] == path]
+        others = sorted(item[:3] for item in segments if item[0] > 0)
+        for offset, member, tar_name in others:
+            if tar_name not in self._indexes:
+                # Only tar headers are read: data ranges of segments in a tar
+                members = self._manager(tar_name).tar_members(tar_name, self._tars[tar_name]['size'])
+                self._indexes[tar_name] = {tarinfo.name: (tarinfo.offset_data, tarinfo.size) for tarinfo, _, _ in members}
+            start, size = self._indexes[tar_name][member]
+            if offset != len(content):
+                raise ValueError(f"Segments of {path} are not contiguous at offset {offset}")
+            content += self._manager(tar_name).read_range(tar_name, start, start + size)
+        if len(content) != segments[0][3]:
+            raise ValueError(f"Segments of {path} are incomplete: {len(content)} of {segments[0][3]} bytes")
+        return bytes(content)
@@ -0,0 +1,71 @@
+"""content-addressed deduplication of identical files: size prefilter, hash of the first bytes, then full hash"""
+import os
+import hashlib
+import concurrent.futures
+import s3split.common
+
+# Bytes hashed to split files of the same size before a full hash, files up to HEAD_SIZE are hashed once
+HEAD_SIZE = 64 * 1024
+# Smaller files are not deduplicated: a reference in metadata costs about as much as the data
+MIN_SIZE = 1024
+READ_SIZE = 1024 * 1024
+
+
+def file_hash(path, length=None):
+    """blake2b digest of the first length bytes of a file (whole file when length is None)"""
+    digest = hashlib.blake2b(digest_size=32)
+    remaining = length
+    with open(path, 'rb') as file:
+        while remaining is None or remaining > 0:
+            data = file.read(READ_SIZE if remaining is None else min(READ_SIZE, remaining))
+            if not data:
+                break
+            digest.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return digest.hexdigest()
+
+
+def _group(indexes, key, executor):
+    """group indexes by key(index) computed in parallel, return groups of at least two indexes"""
+    groups = {}
+    for index, value in zip(indexes, executor.map(key, indexes)):
+        groups.setdefault(value, []).append(index)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(base_path, plan, threads=8, min_size=MIN_SIZE):
+    """find files with identical content among the files of plan (whole files of a plan.Plan)
+
+    Only files sharing their size with another file are read: the first HEAD_SIZE bytes are hashed, then files
+    still colliding are hashed completely. Symbolic links are never duplicates. Return {duplicate index: original index}, the original of a content is
+    the file with the lowest index.
+    """
+    logger = s3split.common.get_logger()
+    counts = {}
+    for index in range(plan.files):
+        size = plan.size(index)
+        if size >= min_size:
+            counts[size] = counts.get(size, 0) + 1
+    by_size = {}
+    for index in range(plan.files):
+        # A symbolic link is stored as a link: hashing its target would make one of them a copy of the other
+        if counts.get(plan.size(index), 0) > 1 and not os.path.islink(os.path.join(base_path, plan.path(index))):
+            by_size.setdefault(plan.size(index), []).append(index)
+    del counts
+    by_size = {size: indexes for size, indexes in by_size.items() if len(indexes) > 1}
+    duplicates = {}
+    hashed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for size, indexes in by_size.items():
+            hashed += len(indexes)
+            groups = _group(indexes, lambda index: file_hash(os.path.join(base_path, plan.path(index)), HEAD_SIZE), executor)
+            if size > HEAD_SIZE:
+                groups = [group for candidates in groups for group in
+                          _group(candidates, lambda index: file_hash(os.path.join(base_path, plan.path(index))), executor)]
+            for group in groups:
+                for index in group[1:]:
+                    duplicates[index] = group[0]
+    logger.info(f"Dedup: {hashed} files with a shared size hashed, {len(duplicates)} duplicates of "
+                f"{len(set(duplicates.values()))} files, {s3split.common.sizeof_fmt(sum(plan.size(index) for index in duplicates))} not uploaded")
+    return duplicates
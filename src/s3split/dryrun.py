@@ -0,0 +1,130 @@
+"""dry run: plan an upload and estimate requests and transfer time without touching S3
+
+This module must not import boto3 (s3split.s3util) at module level: a dry run starts fast.
+"""
+import os
+import math
+import time
+import statistics
+import s3split.common
+
+TAR_HEADER_SIZE = 512
+TAR_END_SIZE = 1024
+TAR_RECORD_SIZE = 10240
+
+
+def estimate_tar_size(split):
+    """estimate tar size of a split: a header and on average half a block of padding per file"""
+    members = s3split.common.split_files(split)
+    size = split.get('size') + members * (TAR_HEADER_SIZE + TAR_HEADER_SIZE // 2) + TAR_END_SIZE
+    return math.ceil(size / TAR_RECORD_SIZE) * TAR_RECORD_SIZE
+
+
+def count_requests(tar_size):
+    """S3 requests to upload a tar: a single PUT or create + parts + complete for multipart uploads"""
+    if tar_size < s3split.common.MULTIPART_THRESHOLD:
+        return {'put': 1, 'multipart_uploads': 0, 'parts': 0}
+    return {'put': 0, 'multipart_uploads': 1, 'parts': math.ceil(tar_size / s3split.common.MULTIPART_CHUNKSIZE)}
+
+
+def estimate(splits, bandwidth, latency, threads):
+    """estimate tars, requests and transfer time
+
+    :param bandwidth: aggregate bandwidth in bytes per second
+    :param latency: seconds per request
+    :param threads: parallel tar transfers, every multipart tar sends up to MULTIPART_CONCURRENCY parts in parallel
+    """
+    tar_sizes = [estimate_tar_size(split) for split in splits]
+    requests = {'put': 0, 'multipart_uploads': 0, 'parts': 0}
+    for tar_size in tar_sizes:
+        for key, value in count_requests(tar_size).items():
+            requests[key] += value
+    # create and complete for every multipart upload, metadata is uploaded twice
+    total_requests = requests['put'] + requests['parts'] + 2 * requests['multipart_uploads'] + 2
+    total_bytes = sum(tar_sizes)
+    parallel_requests = threads * (s3split.common.MULTIPART_CONCURRENCY if requests['parts'] > 0 else 1)
+    transfer_time = total_bytes / bandwidth
+    request_time = total_requests * latency / min(parallel_requests, max(total_requests, 1))
+    # the biggest tar can not be faster than all bandwidth on a single tar
+    seconds = max(transfer_time + request_time, max(tar_sizes, default=0) / bandwidth)
+    return {'tars': len(tar_sizes), 'files': sum(s3split.common.split_files(split) for split in splits), 'bytes': total_bytes,
+            'tar_sizes': tar_sizes, 'requests': requests, 'total_requests': total_requests, 'seconds': seconds}
+
+
+def size_distribution(tar_sizes, max_size):
+    """count tars by size as a fraction of the requested tar size"""
+    buckets = {'< 25%': 0, '25-50%': 0, '50-75%': 0, '75-100%': 0, '> 100%': 0}
+    for size in tar_sizes:
+        fraction = size / max_size
+        if fraction < 0.25:
+            buckets['< 25%'] += 1
+        elif fraction < 0.5:
+            buckets['25-50%'] += 1
+        elif fraction < 0.75:
+            buckets['50-75%'] += 1
+        elif fraction <= 1:
+            buckets['75-100%'] += 1
+        else:
+            buckets['> 100%'] += 1
+    return buckets
+
+
+def probe(args, size):
+    """measure request latency and single stream bandwidth against the S3 endpoint, return (bandwidth, latency)"""
+    import s3split.s3util  # pylint: disable=import-outside-toplevel
+    logger = s3split.common.get_logger()
+    s3uri = s3split.common.S3Uri(args.target)
+    s3_manager = s3split.s3util.S3Manager(args.s3_access_key, args.s3_secret_key, args.s3_endpoint, args.s3_verify_certificate,
+                                          s3uri.bucket, s3uri.object)
+    if not s3_manager.bucket_exsist():
+        raise ValueError(f"Probe needs an existing bucket: {s3uri.bucket}")
+    backend = s3_manager.get_client()
+    key = f"{s3uri.object}/s3split-probe"
+    latencies = []
+    for _ in range(5):
+        start = time.time()
+        backend.put_object(s3uri.bucket, key, b"")
+        latencies.append(time.time() - start)
+    start = time.time()
+    backend.put_object(s3uri.bucket, key, b"\0" * size)
+    elapsed = max(time.time() - start - statistics.median(latencies), 1e-6)
+    backend.delete_object(s3uri.bucket, key)
+    bandwidth = size / elapsed
+    logger.info(f"Probe: request latency {round(statistics.median(latencies) * 1000, 1)} ms, single stream {s3split.common.sizeof_fmt(bandwidth)}/s")
+    return bandwidth, statistics.median(latencies)
+
+
+def run_dry_run(args):
+    """plan an upload and print an estimate"""
+    logger = s3split.common.get_logger()
+    if not os.path.isdir(args.source):
+        raise ValueError(f"upload source: '{args.source}' is not a directory")
+    s3split.common.S3Uri(args.target)
+    threads = args.threads_max if args.threads == "auto" else args.threads
+    bandwidth = args.bandwidth * 1024 * 1024
+    latency = args.latency / 1000
+    if args.probe:
+        stream_bandwidth, latency = probe(args, args.probe_size * 1024 * 1024)
+        # Assume bandwidth scales with parallel streams
+        bandwidth = stream_bandwidth * threads
+    time_start = time.time()
+    splits = s3split.common.split_file_by_size(args.source, args.tar_size * 1024 * 1024, args.scan_cache, args.dedup, threads)
+    scan_time = time.time() - time_start
+    result = estimate(splits, bandwidth, latency, threads)
+    tar_sizes = result['tar_sizes']
+    distribution = size_distribution(tar_sizes, args.tar_size * 1024 * 1024)
+    sizes = (f"min {s3split.common.sizeof_fmt(min(tar_sizes))}, median {s3split.common.sizeof_fmt(statistics.median(tar_sizes))}, "
+             f"max {s3split.common.sizeof_fmt(max(tar_sizes))}") if len(tar_sizes) > 0 else "-"
+    logger.info(f"\n --- dry run (no data is uploaded) ---\n"
+                f"Scan time: {round(scan_time, 1)} seconds\n"
+                f"Files: {result['files']}\n"
+                f"Tars: {result['tars']} ({s3split.common.sizeof_fmt(result['bytes'])})\n"
+                f"Tar size: {sizes}\n"
+                f"Tar size distribution (of --tar-size {args.tar_size} MB): "
+                f"{', '.join(f'{bucket}: {count}' for bucket, count in distribution.items())}\n"
+                f"Requests: {result['total_requests']} (PUT: {result['requests']['put']}, multipart uploads: "
+                f"{result['requests']['multipart_uploads']}, parts: {result['requests']['parts']}, "
+                f"part size: {s3split.common.sizeof_fmt(s3split.common.MULTIPART_CHUNKSIZE)})\n"
+                f"Model: bandwidth {s3split.common.sizeof_fmt(bandwidth)}/s, latency {round(latency * 1000, 1)} ms, threads {threads}\n"
+                f"Estimated upload time: {round(result['seconds'])} seconds")
+    return result
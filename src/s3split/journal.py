@@ -0,0 +1,72 @@
+"""download journal: tars fully extracted in a target directory, used to resume an interrupted download"""
+import os
+import json
+import threading
+
+
+class DownloadJournal():
+    """Append only json lines file in the download target
+
+    The first line identifies the dataset (S3 uri and metadata date), every other line is a tar fully extracted
+    with the prefix used (None for the whole tar). Lines are flushed and synced one by one: a crash loses at most
+    the line being written, that tar is extracted again. The journal is removed when the download is completed.
+    """
+    NAME = ".s3split-journal"
+
+    def __init__(self, target, uri, date, resume=False):
+        self.path = os.path.join(target, self.NAME)
+        self._lock = threading.Lock()
+        self._completed = set()
+        dataset = {'dataset': uri, 'date': date}
+        if resume and os.path.isfile(self.path):
+            with open(self.path) as file:
+                content = file.read()
+            lines = content.splitlines()
+            header = self._parse(lines[0]) if len(lines) > 0 else None
+            if header is not None and header != dataset:
+                raise ValueError(f"download journal {self.path} belongs to dataset {header.get('dataset')} "
+                                 f"uploaded on {header.get('date')}, can not resume")
+            for line in lines[1:]:
+                record = self._parse(line)
+                if record is not None:
+                    self._completed.add((record['tar'], record.get('prefix')))
+            self._file = open(self.path, 'a')
+            if content and not content.endswith("\n"):
+                # Terminate a line truncated by a crash, new records are not appended to it
+                self._file.write("\n")
+            if header is None:
+                self._write(dataset)
+        else:
+            self._file = open(self.path, 'w')
+            self._write(dataset)
+
+    @staticmethod
+    def _parse(line):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def completed(self, name, prefix=None):
+        """True if tar was extracted as a whole or with the same prefix"""
+        return (name, None) in self._completed or (name, prefix) in self._completed
+
+    def done(self, name, prefix=None, files=None):
+        """record a tar fully extracted"""
+        with self._lock:
+            self._completed.add((name, prefix))
+            self._write({'tar': name, 'prefix': prefix, 'files': files})
+
+    def __len__(self):
+        return len(self._completed)
+
+    def close(self, remove=False):
+        """close journal file, removed when the download is completed"""
+        self._file.close()
+        if remove:
+            os.remove(self.path)
@@ -2,18 +2,20 @@
 import os
 import sys
 import argparse
+import importlib
 import threading
 import signal
 from distutils.util import strtobool
 
 # This is the main file, only absolute path import are allowed here!!!
-import s3split.s3util
+# s3split.actions (boto3) is imported only when a command needs S3, a dry run does not import boto3
 import s3split.common
-import s3split.actions
+import s3split.dryrun
+import s3split.storage
 
 
-def parse_args(sys_args):
-    """parse command line arguments"""
+def build_parser():
+    """command line parser, option defaults are read from env variables when the parser is built"""
     def str2bool(val):
         return bool(strtobool(val))
 
@@ -24,12 +26,24 @@ def parse_args(sys_args):
     group_options.add_argument('--s3-secret-key', help='S3 secret key (can be set with env variable S3_SECRET_KEY)', default=os.environ.get('S3_SECRET_KEY', None), required=False)
     group_options.add_argument('--s3-access-key', help='S3 access key (can be set with env variable S3_ACCESS_KEY)', default=os.environ.get('S3_ACCESS_KEY', None), required=False)
     group_options.add_argument('--s3-endpoint', default=os.environ.get('S3_ENDPOINT', None),
-                               help='S3 endpoint full hostname in the form http(s)://myhost:port (can be set with env variable S3_ENDPOINT)', required=False)
+                               help=('S3 endpoint full hostname in the form http(s)://myhost:port, or a local storage file:///path or mem://name '
+                                     'with optional ?latency=MS&bandwidth=MBS (can be set with env variable S3_ENDPOINT)'), required=False)
     # Boolean type does not work as expected... check https://stackoverflow.com/questions/15008758
     group_options.add_argument('--s3-verify-certificate', help='verfiy S3 endpoint tls certificate (can be set with env variable S3_VERIFY_CERTIFICATE)',
                                type=str2bool, default=os.environ.get('S3_VERIFY_CERTIFICATE', True))
-    group_options.add_argument('--threads', help='Number of parallel threads ', type=int, default=5)
+    def threads(val):
+        return val if val == "auto" else int(val)
+
+    group_options.add_argument('--threads', help=("Number of parallel threads or 'auto' to tune concurrency from measured throughput "
+                                                  "and throttling (AIMD)"), type=threads, default=5)
+    group_options.add_argument('--threads-max', help="Maximum number of parallel threads with --threads auto", type=int, default=32)
     group_options.add_argument('--stats-interval', help='Seconds between two stats print', type=int, default=30)
+    group_options.add_argument('--retries', help='Retries with exponential backoff for a failed S3 request (a single multipart part)', type=int, default=5)
+    group_options.add_argument('--metrics-port', help='Serve OpenMetrics/Prometheus metrics on http://0.0.0.0:PORT/metrics', type=int, required=False)
+    group_options.add_argument('--metrics-textfile', help='Write OpenMetrics metrics to a file every --stats-interval seconds (textfile collector)',
+                               required=False)
+    group_options.add_argument('--event-log', help='Append json lines lifecycle events (planned, tar built, transfer started/completed/failed)',
+                               required=False)
     subparsers = parser.add_subparsers(title='COMMAND', dest='command', required=True, help='%(prog)s [COMMAND] -h to see the full command help')
     # Upload
     parser_upload = subparsers.add_parser("upload", help="Split a dataset from source folder in multiple tar files and upload them to remote S3 target (upload -h to show more help)")
@@ -37,18 +51,63 @@ def parse_args(sys_args):
     parser_upload.add_argument('target', help="S3 path in the form s3://bucket/path (path is required!)")
     parser_upload.add_argument('-s', '--tar-size', help='Desired size in MB for a single split tar file', type=int, default=1024)
     parser_upload.add_argument('-d', '--description', help='Dataset description', required=False)
+    parser_upload.add_argument('--scan-cache', help='Local file caching the source directory scan, only directories with a new mtime are read again',
+                               required=False)
+    parser_upload.add_argument('--dedup', help=('Store identical files once: files of the same size are hashed, duplicates are saved as '
+                                                'references in metadata and restored on download'), action='store_true')
+    parser_upload.add_argument('--dry-run', help='Scan source and plan tars, print requests and time estimates without touching S3',
+                               action='store_true')
+    parser_upload.add_argument('--bandwidth', help='Dry run: aggregate bandwidth in MB/s for the time estimate', type=float, default=100)
+    parser_upload.add_argument('--latency', help='Dry run: request latency in ms for the time estimate', type=float, default=20)
+    parser_upload.add_argument('--probe', help='Dry run: calibrate bandwidth and latency with a short probe against the S3 endpoint',
+                               action='store_true')
+    parser_upload.add_argument('--probe-size', help='Dry run: size in MB of the probe object', type=int, default=16)
+    parser_upload.add_argument('--multipart-state', help=('Local json file where multipart upload ids and completed parts are saved, '
+                                                          'run again the same upload to resume interrupted multipart uploads'), required=False)
+    parser_upload.add_argument('--stripe', help=('Stripe tars on another endpoint/bucket in the form ENDPOINT,s3://bucket/path[,WEIGHT] '
+                                                 '(repeat for more stripes), metadata is saved on target only'),
+                               action='append', type=s3split.common.parse_stripe)
+    parser_upload.add_argument('--target-weight', help='Stripe weight of the upload target: tar bytes are spread proportionally to weights',
+                               type=float, default=1)
+    parser_upload.add_argument('--key-prefixes', help=('Spread tars across N hashed sub-prefixes of the target path (path/<hex>/s3split-part-N.tar) '
+                                                       'to avoid S3 request rate hot spots on a single key prefix, 0 disables'),
+                               type=int, default=0)
     # Download
     parser_download = subparsers.add_parser("download", help="Download dataset tar files from s3 source and join them in a local target folder (download -h to show more help)")
     parser_download.add_argument('source', help="S3 path in the form s3://bucket/path (path is required!)")
     parser_download.add_argument('target', help="Local filesystem directory")
     parser_download.add_argument('-p', '--prefix', help='folders and file name to restrict download to', required=False)
+    parser_download.add_argument('--cache-dir', help='Local directory used to cache downloaded tars between runs (can be set with env variable S3SPLIT_CACHE_DIR)',
+                                 default=os.environ.get('S3SPLIT_CACHE_DIR', None), required=False)
+    parser_download.add_argument('--cache-size', help='Maximum cache size in MB, least recently used tars are evicted', type=int, default=10240)
+    parser_download.add_argument('--duplicates', help='Restore duplicates of a deduplicated dataset as copies or hardlinks of the extracted file',
+                                 choices=['copy', 'hardlink'], default='copy')
+    parser_download.add_argument('--resume', help='Resume an interrupted download in an existing target: tars already extracted are skipped',
+                                 action='store_true', default=False)
+    # Repack
+    parser_repack = subparsers.add_parser("repack", help=("Rebuild dataset tars with a new tar size copying data server side "
+                                                          "(repack -h to show more help)"))
+    parser_repack.add_argument('source', help="S3 path of an existing dataset in the form s3://bucket/path")
+    parser_repack.add_argument('target', help="S3 path for the repacked dataset in the form s3://bucket/path (same S3 endpoint)")
+    parser_repack.add_argument('-s', '--tar-size', help='Desired size in MB for a single split tar file', type=int, default=1024)
+    parser_repack.add_argument('--key-prefixes', help='Spread repacked tars across N hashed sub-prefixes of the target path, 0 disables',
+                               type=int, default=0)
     # Check
     parser_check = subparsers.add_parser("check", help="Compare S3 metadata info (tar name and size) with remote S3 object (check -h to show more help)")
     parser_check.add_argument('target', help="S3 path in the form s3://bucket/...")
+    return parser
+
+
+def parse_args(sys_args):
+    """parse command line arguments"""
     # Parse s3 config from env vars
-    args = parser.parse_args(sys_args)
+    args = build_parser().parse_args(sys_args)
     # print(args)
-    for key in ['s3_secret_key', 's3_access_key', 's3_endpoint', 's3_verify_certificate']:
+    if args.command == "upload" and args.dry_run and not args.probe:
+        return args
+    # Local storage endpoints do not need credentials
+    keys = ['s3_endpoint'] if s3split.storage.is_local(args.s3_endpoint) else ['s3_secret_key', 's3_access_key', 's3_endpoint']
+    for key in keys + ['s3_verify_certificate']:
         if vars(args).get(key) is None:
             raise ValueError(f"Error! param --{key.replace('_','-')} or env variables {key.upper()} is required")
     return args
@@ -76,7 +135,11 @@ def run_main(sys_args):
         args = parse_args(sys_args)
         # logger.info(f"Args: {args}")
         logger.info(f"Parallel threads: {args.threads}")
-        action = s3split.actions.Action(args, event)
+        if args.command == "upload" and args.dry_run:
+            s3split.dryrun.run_dry_run(args)
+        else:
+            actions = importlib.import_module("s3split.actions")
+            actions.Action(args, event).run()
     except ValueError as ex:
         raise SystemExit(f"Error! {ex}")
 
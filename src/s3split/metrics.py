@@ -0,0 +1,140 @@
+"""machine readable metrics: OpenMetrics endpoint/textfile and json lines event log"""
+import os
+import re
+import json
+import time
+import queue
+import threading
+import http.server
+import s3split.common
+
+
+def openmetrics(snapshot, labels=None):
+    """format a Stats snapshot in OpenMetrics text format, values written with Stats.set are gauges"""
+    label = ",".join(f'{key}="{value}"' for key, value in sorted((labels or {}).items()))
+    label = f"{{{label}}}" if len(label) > 0 else ""
+    lines = []
+
+    def _metric(name, kind, value, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name}{'_total' if kind == 'counter' else ''}{label} {value}")
+    _metric("s3split_bytes_transferred", "counter", snapshot['bytes_transferred'], "Bytes transferred")
+    _metric("s3split_bytes", "gauge", snapshot['bytes_total'], "Bytes to transfer")
+    _metric("s3split_bytes_remaining", "gauge", max(0, snapshot['bytes_total'] - snapshot['bytes_transferred']), "Bytes not transferred yet")
+    _metric("s3split_tars", "gauge", snapshot['files_total'], "Tars to transfer")
+    _metric("s3split_tars_completed", "counter", snapshot['files_completed'], "Tars transferred")
+    _metric("s3split_elapsed_seconds", "gauge", snapshot['elapsed'], "Seconds since start")
+    gauges = set(snapshot.get('gauges', []))
+    for name, value in sorted(snapshot['counters'].items()):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            metric = "s3split_" + re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+            _metric(metric, "gauge" if name in gauges else "counter", value, name)
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter():
+    """Expose Stats counters on an http endpoint (/metrics) and/or in a textfile for node exporter textfile collector
+
+    Metrics are read from a Stats snapshot only when scraped, transfer callbacks are not affected.
+    """
+
+    def __init__(self, stats, port=None, textfile=None, interval=15, labels=None):
+        self._logger = s3split.common.get_logger()
+        self._stats = stats
+        self._port = port
+        self._textfile = textfile
+        self._interval = interval
+        self._labels = labels
+        self._server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def render(self):
+        """current metrics in OpenMetrics text format"""
+        return openmetrics(self._stats.snapshot(), self._labels)
+
+    def _write_textfile(self):
+        tmp_path = f"{self._textfile}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(self.render())
+        os.replace(tmp_path, self._textfile)
+
+    def _run_textfile(self):
+        while not self._stop.wait(self._interval):
+            self._write_textfile()
+
+    def start(self):
+        """start http server and textfile writer threads"""
+        exporter = self
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                return
+        if self._port is not None:
+            self._server = http.server.ThreadingHTTPServer(('', self._port), _Handler)
+            self._threads.append(threading.Thread(target=self._server.serve_forever, daemon=True))
+            self._logger.info(f"Metrics endpoint http://0.0.0.0:{self._server.server_address[1]}/metrics")
+        if self._textfile is not None:
+            self._threads.append(threading.Thread(target=self._run_textfile, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def port(self):
+        """port of the http endpoint (useful with port 0)"""
+        return self._server.server_address[1] if self._server is not None else None
+
+    def stop(self):
+        """stop threads, textfile is written a last time with final values"""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._textfile is not None:
+            self._write_textfile()
+
+
+class EventLog():
+    """Append only json lines log of lifecycle events, lines are written by a background thread"""
+    _CLOSE = object()
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is self._CLOSE:
+                break
+            self._file.write(json.dumps(event) + "\n")
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def emit(self, event, **fields):
+        """log an event with a timestamp and extra fields"""
+        self._queue.put({'time': time.time(), 'event': event, **fields})
+
+    def close(self):
+        """write pending events and close file"""
+        self._queue.put(self._CLOSE)
+        self._thread.join()
@@ -0,0 +1,133 @@
+"""compact upload plan: tens of millions of files without a python object per file"""
+import os
+import array
+
+
+class Split():
+    """A split of a Plan, file paths are built from plan arrays only when requested
+
+    Behaves like the split dicts of metadata: split.get('paths'), split['size'], ...
+    """
+    __slots__ = ('_plan', 'id', 'size', '_start', '_end', 'segments', 'duplicates')
+
+    def __init__(self, plan, split_id, size, start, end, segments=None, duplicates=None):
+        self._plan = plan
+        self.id = split_id
+        self.size = size
+        self._start = start
+        self._end = end
+        self.segments = segments
+        self.duplicates = duplicates
+
+    @property
+    def paths(self):
+        """relative paths of whole files in this split"""
+        return [self._plan.path(index) for index in range(self._start, self._end)]
+
+    @property
+    def files(self):
+        """number of tar members: whole files and segments"""
+        return self._end - self._start + len(self.segments or [])
+
+    def get(self, key, default=None):
+        """dict like access"""
+        if key == 'paths':
+            return self.paths
+        if key in ('id', 'size'):
+            return getattr(self, key)
+        if key == 'segments' and self.segments:
+            return self.segments
+        if key == 'duplicates' and self.duplicates:
+            return self.duplicates
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def to_dict(self):
+        """split in metadata format"""
+        split = {'paths': self.paths, 'size': self.size, 'id': self.id}
+        if self.segments:
+            split['segments'] = self.segments
+        if self.duplicates:
+            split['duplicates'] = self.duplicates
+        return split
+
+    def __eq__(self, other):
+        return self.to_dict() == (other.to_dict() if isinstance(other, Split) else other)
+
+    def __repr__(self):
+        return f"Split(id={self.id}, size={self.size}, files={self.files})"
+
+
+class Plan():
+    """Splits of an upload
+
+    Directory prefixes are interned, file names are stored in a single utf-8 buffer with array backed offsets,
+    directory indexes and sizes: a few tens of bytes per file instead of a python string in a list.
+    Split records (`__slots__`) only keep a range of file indexes.
+    """
+
+    def __init__(self):
+        self._dirs = []
+        self._dir_index = {}
+        self._file_dir = array.array('I')
+        self._name_end = array.array('Q')
+        self._sizes = array.array('Q')
+        self._names = bytearray()
+        self._splits = []
+
+    def directory(self, path):
+        """interned index of a relative directory ('' for the base directory)"""
+        index = self._dir_index.get(path)
+        if index is None:
+            index = self._dir_index[path] = len(self._dirs)
+            self._dirs.append(path)
+        return index
+
+    def add_file(self, directory, name, size):
+        """add a file of a directory index to the current split"""
+        self._names += name.encode('utf-8', 'surrogateescape')
+        self._name_end.append(len(self._names))
+        self._file_dir.append(directory)
+        self._sizes.append(size)
+
+    def add_split(self, size, segments=None, duplicates=None):
+        """close the current split with files added since the previous split
+
+        duplicates maps paths of files (or segmented files) of the split to paths of identical files not uploaded.
+        """
+        start = self._splits[-1]._end if self._splits else 0  # pylint: disable=protected-access
+        self._splits.append(Split(self, len(self._splits) + 1, size, start, len(self._name_end), segments or None,
+                                  duplicates or None))
+
+    def path(self, index):
+        """relative path of a file"""
+        start = self._name_end[index - 1] if index > 0 else 0
+        name = self._names[start:self._name_end[index]].decode('utf-8', 'surrogateescape')
+        directory = self._dirs[self._file_dir[index]]
+        return os.path.join(directory, name) if directory else name
+
+    def size(self, index):
+        """size of a file at planning time"""
+        return self._sizes[index]
+
+    @property
+    def files(self):
+        """number of whole files in the plan"""
+        return len(self._name_end)
+
+    def __len__(self):
+        return len(self._splits)
+
+    def __iter__(self):
+        return iter(self._splits)
+
+    def __getitem__(self, index):
+        return self._splits[index]
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(split == other_split for split, other_split in zip(self, other))
@@ -1,9 +1,14 @@
 """S3 utility: connection manager, s3 url"""
 import os
+import time
+import random
+import hashlib
 import threading
+import concurrent.futures
 import json
-import re
 import datetime
+import tarfile
+import tempfile
 from distutils.util import strtobool
 from urllib.parse import urlparse
 import urllib3
@@ -11,30 +16,14 @@ import boto3
 import boto3.session
 import botocore
 from botocore.exceptions import ClientError
-from boto3.s3.transfer import TransferConfig
 import s3split.common
+import s3split.storage
 
 # logger = s3split.common.get_logger()
 urllib3.disable_warnings()
 
-# From https://github.com/s3tools/s3cmd/blob/master/S3/S3Uri.py
-
-
-class S3Uri():
-    """Contain a s3 url s3://bucket/object"""
-    _re = re.compile("^s3:///*([^/]*)/?(.*)", re.IGNORECASE | re.UNICODE)
-
-    def __init__(self, string):
-        self.bucket = None
-        self.object = None
-        match = self._re.match(string)
-        if not match:
-            raise ValueError("%s: not a S3 URI" % string)
-        groups = match.groups()
-        self.bucket = groups[0]
-        self.object = groups[1]
-        if len(self.object) == 0:
-            raise SystemExit(f"S3 URI must contains bucket and path s3://bucket/path")
+# S3Uri does not depend on boto3, it is defined in common and available here as before
+S3Uri = s3split.common.S3Uri
 
 
 class ProgressPercentage(object):
@@ -56,6 +45,184 @@ class ProgressPercentage(object):
                 self._cb_stats_update(self._filename, bytes_amount, self._size)
 
 
+RETRY_ERROR_CODES = {'InternalError', 'ServiceUnavailable', 'SlowDown', 'Throttling', 'ThrottlingException',
+                     'RequestLimitExceeded', 'RequestTimeout', 'RequestTimeTooSkewed', '500', '502', '503', '504'}
+THROTTLE_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', '503'}
+
+
+def is_retryable(ex):
+    """True for transient errors: 5xx, throttling and connection errors"""
+    if isinstance(ex, ClientError):
+        status = ex.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return ex.response.get('Error', {}).get('Code') in RETRY_ERROR_CODES or status >= 500
+    return isinstance(ex, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError,
+                           botocore.exceptions.IncompleteReadError))
+
+
+def is_throttle(ex):
+    """True when S3 endpoint asks to slow down"""
+    return isinstance(ex, ClientError) and ex.response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES
+
+
+def retry_call(func, retries, cb_retry=None, backoff=0.5, max_backoff=30):
+    """call func, retry transient errors with exponential backoff and full jitter"""
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as ex:  # pylint: disable=broad-except
+            if attempt >= retries or not is_retryable(ex):
+                raise
+            attempt += 1
+            delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+            if callable(cb_retry):
+                cb_retry(ex, attempt, delay)
+            time.sleep(delay)
+
+
+def plan_compose_parts(pieces, min_part=5 * 1024 * 1024, max_copy_part=1024 * 1024 * 1024):
+    """plan multipart parts to build an object from pieces: bytes (local data) or (key, start, end) byte ranges
+
+    Return a list of ('copy', key, start, end) parts copied server side and ('data', segments) parts
+    uploaded from local memory. S3 requires every part but the last one to be at least min_part bytes,
+    so ranges smaller than min_part are fetched and merged with their neighbours in a data part.
+    """
+    parts = []
+    pending = []
+    pending_size = 0
+
+    def _add(segment, size):
+        nonlocal pending, pending_size
+        pending.append(segment)
+        pending_size += size
+        if pending_size >= min_part:
+            parts.append(('data', pending))
+            pending = []
+            pending_size = 0
+
+    for piece in pieces:
+        if isinstance(piece, bytes):
+            _add(piece, len(piece))
+            continue
+        key, start, end = piece
+        while start < end:
+            if pending_size > 0:
+                # complete pending data part with the head of this range
+                size = min(min_part - pending_size, end - start)
+                _add((key, start, start + size), size)
+            elif end - start < min_part:
+                size = end - start
+                _add((key, start, end), size)
+            else:
+                size = min(end - start, max_copy_part)
+                remaining = end - start - size
+                if 0 < remaining < min_part:
+                    size -= min_part - remaining
+                parts.append(('copy', key, start, start + size))
+            start += size
+    if pending_size > 0:
+        parts.append(('data', pending))
+    return parts
+
+
+class S3RangeReader():
+    """Read only seekable file object over an object of a storage backend, data is fetched with ranged gets of block_size bytes
+
+    Allow tarfile to read only member headers of a remote tar.
+    """
+
+    def __init__(self, backend, bucket, key, size, block_size=64 * 1024, retries=5, cb_retry=None):
+        self._backend = backend
+        self._bucket = bucket
+        self._key = key
+        self._size = size
+        self._block_size = block_size
+        self._retries = retries
+        self._cb_retry = cb_retry
+        self._pos = 0
+        self._block_start = 0
+        self._block = b""
+        self.requests = 0
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = offset
+        return self._pos
+
+    def _fetch(self, start, end):
+        self.requests += 1
+        return retry_call(lambda: self._backend.get_object(self._bucket, self._key, start, end), self._retries, self._cb_retry)
+
+    def read(self, size=-1):
+        end = self._size if size < 0 else min(self._pos + size, self._size)
+        if self._pos >= end:
+            return b""
+        if not self._block_start <= self._pos or end > self._block_start + len(self._block):
+            self._block_start = self._pos
+            self._block = self._fetch(self._pos, max(end, min(self._pos + self._block_size, self._size)))
+        data = self._block[self._pos - self._block_start:end - self._block_start]
+        self._pos += len(data)
+        return data
+
+
+class MultipartState():
+    """Persist multipart upload ids and completed part etags in a local json file, allow resume of interrupted uploads"""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._uploads = {}
+        if os.path.isfile(path):
+            with open(path) as file:
+                self._uploads = json.load(file)
+
+    def _save(self):
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self._uploads, file)
+        os.replace(tmp_path, self._path)
+
+    def get(self, key):
+        """return saved upload for an object key"""
+        with self._lock:
+            return self._uploads.get(key)
+
+    def start(self, key, upload_id, size, chunksize):
+        """save a new multipart upload"""
+        with self._lock:
+            self._uploads[key] = {'upload_id': upload_id, 'size': size, 'chunksize': chunksize, 'parts': {}}
+            self._save()
+
+    def part_done(self, key, number, etag):
+        """save a completed part"""
+        with self._lock:
+            self._uploads[key]['parts'][str(number)] = etag
+            self._save()
+
+    def done(self, key):
+        """remove a completed multipart upload"""
+        with self._lock:
+            self._uploads.pop(key, None)
+            self._save()
+
+    def upload_ids(self):
+        """multipart upload ids that can still be resumed"""
+        with self._lock:
+            return {upload['upload_id'] for upload in self._uploads.values()}
+
+
 # class S3ManagerBuilder():
 #     """Build a new S3manager with thread safe client/session"""
 
@@ -73,44 +240,176 @@ class ProgressPercentage(object):
 #         return S3Manager(client)
 
 
+def new_client(s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate, max_pool_connections=10):
+    """new boto3 s3 client, botocore retries are disabled (see retry_call)"""
+    try:
+        url = urlparse(s3_endpoint)
+        # Multithread https://boto3.amazonaws.com/v1/documentation/api/latest/guide/resources.html?highlight=threads#multithreading-multiprocessing
+        return boto3.session.Session().client('s3', aws_access_key_id=s3_access_key, aws_secret_access_key=s3_secret_key,
+                                              endpoint_url=s3_endpoint, use_ssl=url.scheme == "https", verify=s3_verify_certificate,
+                                              config=botocore.config.Config(max_pool_connections=max_pool_connections,
+                                                                            retries={'mode': 'standard', 'max_attempts': 1}))
+    except ValueError as ex:
+        raise ValueError(f"S3 validation - {ex}")
+    except ClientError as ex:
+        raise SystemExit(f"Fatal boto3 exception - {ex}")
+
+
+NOT_FOUND_ERROR_CODES = {'NoSuchKey', 'NoSuchBucket', 'NoSuchUpload', '404'}
+
+
+class S3Backend(s3split.storage.Backend):
+    """storage.Backend of a S3 endpoint with a boto3 client, missing objects and uploads raise storage.NotFound"""
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _not_found(ex):
+        if isinstance(ex, ClientError) and ex.response.get('Error', {}).get('Code') in NOT_FOUND_ERROR_CODES:
+            return s3split.storage.NotFound(str(ex))
+        return ex
+
+    def bucket_exists(self, bucket):
+        try:
+            self.client.head_bucket(Bucket=bucket)
+            return True
+        except ClientError as ex:
+            # If it was a 404 error, then the bucket does not exist.
+            if ex.response['Error']['Code'] == '404':
+                return False
+            raise
+
+    def create_bucket(self, bucket):
+        self.client.create_bucket(Bucket=bucket)
+
+    def list_objects(self, bucket, prefix):
+        # list_objects_v2 returns at most 1000 keys per page
+        objects = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for response in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            objects.extend(response.get('Contents', []))
+        return objects
+
+    def put_object(self, bucket, key, body):
+        self.client.put_object(Bucket=bucket, Key=key, Body=body)
+
+    def get_object(self, bucket, key, start=None, end=None):
+        try:
+            if start is None:
+                return self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+            return self.client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}")['Body'].read()
+        except ClientError as ex:
+            raise self._not_found(ex)
+
+    def open_object(self, bucket, key):
+        try:
+            return self.client.get_object(Bucket=bucket, Key=key)['Body']
+        except ClientError as ex:
+            raise self._not_found(ex)
+
+    def delete_object(self, bucket, key):
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+    def create_multipart_upload(self, bucket, key):
+        return self.client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def upload_part(self, bucket, key, upload_id, number, data):
+        return self.client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)['ETag']
+
+    def upload_part_copy(self, bucket, key, upload_id, number, source_bucket, source_key, start, end):
+        response = self.client.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                                CopySource={'Bucket': source_bucket, 'Key': source_key},
+                                                CopySourceRange=f"bytes={start}-{end - 1}")
+        return response['CopyPartResult']['ETag']
+
+    def list_parts(self, bucket, key, upload_id):
+        parts = {}
+        try:
+            paginator = self.client.get_paginator('list_parts')
+            for response in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+                parts.update({part['PartNumber']: part['ETag'] for part in response.get('Parts', [])})
+        except ClientError as ex:
+            raise self._not_found(ex)
+        return parts
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        self.client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+    def list_multipart_uploads(self, bucket, prefix):
+        uploads = []
+        paginator = self.client.get_paginator('list_multipart_uploads')
+        for response in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            uploads.extend(response.get('Uploads', []))
+        return uploads
+
+
+def new_backend(s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate, max_pool_connections=10):
+    """storage backend of an endpoint: file:// and mem:// are local backends, other endpoints are S3 (boto3)"""
+    if s3split.storage.is_local(s3_endpoint):
+        return s3split.storage.open_backend(s3_endpoint)
+    return S3Backend(new_client(s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate, max_pool_connections))
+
+
+class ClientPool():
+    """storage backends (boto3 clients) shared by S3Manager instances, one backend per endpoint and credentials
+
+    boto3 clients are thread safe: a long running process reuses clients (and their connections) across transfers and jobs.
+    """
+
+    def __init__(self, max_pool_connections=10):
+        self._max_pool_connections = max_pool_connections
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate):
+        """return the shared backend for an endpoint, created on first use"""
+        key = (s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = new_backend(*key, self._max_pool_connections)
+            return self._clients[key]
+
+    def __len__(self):
+        return len(self._clients)
+
+
 class S3Manager():
-    """Manage S3 connection with boto3"""
+    """Manage a dataset path of a storage backend: S3 with boto3 or a local backend (file://, mem:// endpoints)"""
 
     def _wrap_exception(self, ex):
         "exit when detect a fatal client exception"
         raise SystemExit(f"Fatal boto3 exception - {ex}")
 
-    def __init__(self, s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate, s3_bucket, s3_path, cb_stats_update=None):
+    def __init__(self, s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate, s3_bucket, s3_path, cb_stats_update=None,
+                 retries=5, cb_retry=None, multipart_state=None, cb_request=None, client_pool=None, part_pool=None):
         self._logger = s3split.common.get_logger()
         self._cb_stats_update = cb_stats_update
-        self._session = boto3.session.Session()
+        self._retries = retries
+        self._cb_retry = cb_retry
+        self._cb_request = cb_request
+        self._multipart_state = multipart_state
+        self._part_pool = part_pool
         self.s3_bucket = s3_bucket
         self.s3_path = s3_path
-        self._s3_client = None
-        try:
-            url = urlparse(s3_endpoint)
-            self._s3_use_ssl = False
-            if url.scheme == "https":
-                self._s3_use_ssl = True
-            # Multithread https://boto3.amazonaws.com/v1/documentation/api/latest/guide/resources.html?highlight=threads#multithreading-multiprocessing
-            self._s3_client = self._session.client('s3', aws_access_key_id=s3_access_key, aws_secret_access_key=s3_secret_key,
-                                                   endpoint_url=s3_endpoint, use_ssl=self._s3_use_ssl, verify=s3_verify_certificate,
-                                                   config=botocore.config.Config(max_pool_connections=10))
-        except ValueError as ex:
-            raise ValueError(f"S3 validation - {ex}")
-        except ClientError as ex:
-            self._wrap_exception(ex)
+        if client_pool is not None:
+            self._backend = client_pool.get(s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate)
+        else:
+            self._backend = new_backend(s3_access_key, s3_secret_key, s3_endpoint, s3_verify_certificate)
 
     def get_client(self):
-        """return boto3 client"""
-        return self._s3_client
+        """return the storage backend (S3Backend wraps the boto3 client)"""
+        return self._backend
 
     def create_bucket(self):
         """create a bucket"""
         if self.bucket_exsist():
             return True
         try:
-            self._s3_client.create_bucket(Bucket=self.s3_bucket)
+            self._retry(lambda: self._backend.create_bucket(self.s3_bucket))
             return True
         except ClientError as ex:
             self._wrap_exception(ex)
@@ -124,14 +423,8 @@ class S3Manager():
         # Check if a bucket exsists
         # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/migrations3.html?highlight=clienterror#accessing-a-bucket
         try:
-            self._s3_client.head_bucket(Bucket=self.s3_bucket)
-            return True
-        except botocore.exceptions.ParamValidationError as ex:
-            self._wrap_exception(ex)
-        except ClientError as ex:
-            # If it was a 404 error, then the bucket does not exist.
-            if ex.response['Error']['Code'] == '404':
-                return False
+            return self._retry(lambda: self._backend.bucket_exists(self.s3_bucket))
+        except (botocore.exceptions.ParamValidationError, ClientError) as ex:
             self._wrap_exception(ex)
 
     def list_bucket_objects(self):
@@ -141,66 +434,255 @@ class S3Manager():
         :return: List of bucket objects
         """
 
-        # Retrieve the list of bucket objects
         try:
-            response = self._s3_client.list_objects_v2(Bucket=self.s3_bucket, Prefix=self.s3_path)
+            objects = self._retry(lambda: self._backend.list_objects(self.s3_bucket, self.s3_path))
             # Only return the contents if we found some keys
-            if response['KeyCount'] > 0:
-                return response['Contents']
+            if len(objects) > 0:
+                return objects
             return None
-        except ClientError as ex:
+        except (ClientError, s3split.storage.NotFound) as ex:
             self._wrap_exception(ex)
 
     def upload_metadata(self, splits=None, tars=None, description=None):
-        """upload metadata file in json format"""
+        """upload metadata file in json format
+
+        Splits are serialized one at a time in a temporary file: paths of a plan.Plan are never all in memory.
+        """
         content = {
             "version": "0.1",
             "date": datetime.datetime.utcnow().isoformat(),
             "description": description,
-            "tars": tars,
-            "splits": splits}
+            "tars": tars}
         if not self.bucket_exsist():
             self.create_bucket()
-        try:
-            self._s3_client.put_object(Bucket=self.s3_bucket, Key=self.s3_path+'/s3split-metadata.json', Body=json.dumps(content))
-            return True
-        except ClientError as ex:
-            self._wrap_exception(ex)
+        with tempfile.TemporaryFile() as file:
+            file.write(json.dumps(content)[:-1].encode('utf-8'))
+            if splits is None:
+                file.write(b', "splits": null}')
+            else:
+                file.write(b', "splits": [')
+                for index, split in enumerate(splits):
+                    file.write((", " if index > 0 else "").encode('utf-8'))
+                    file.write(json.dumps(split.to_dict() if hasattr(split, 'to_dict') else split).encode('utf-8'))
+                file.write(b']}')
+
+            def _put():
+                # A retry sends the file again from the start
+                file.seek(0)
+                self._backend.put_object(self.s3_bucket, self.s3_path+'/s3split-metadata.json', file)
+            try:
+                self._retry(_put)
+                return True
+            except ClientError as ex:
+                self._wrap_exception(ex)
 
     def download_metadata(self):
         """download metadata and parse json"""
         try:
-            stream = self._s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_path+'/s3split-metadata.json')
-            if stream is not None:
-                data = stream['Body'].read().decode('utf-8')
-                return json.loads(data)
-            else:
-                return None
+            data = self._retry(lambda: self._backend.get_object(self.s3_bucket, self.s3_path+'/s3split-metadata.json')).decode('utf-8')
+            return json.loads(data)
+        except s3split.storage.NotFound:
+            return None
         except ClientError as ex:
             self._wrap_exception(ex)
 
+    def open_object(self, s3_object):
+        """open a streaming body for an object relative to s3 path"""
+        full_path = os.path.join(self.s3_path, s3_object)
+        try:
+            return self._retry(lambda: self._backend.open_object(self.s3_bucket, full_path))
+        except (ClientError, s3split.storage.NotFound) as ex:
+            self._wrap_exception(ex)
+
+    def read_range(self, s3_object, start, end):
+        """bytes [start, end) of an object relative to s3 path"""
+        full_path = os.path.join(self.s3_path, s3_object)
+        try:
+            return self._retry(lambda: self._backend.get_object(self.s3_bucket, full_path, start, end))
+        except (ClientError, s3split.storage.NotFound) as ex:
+            self._wrap_exception(ex)
+
+    def _retry(self, func):
+        """retry transient errors, botocore retries are disabled so every retry is visible to cb_retry
+
+        Every backend request goes through _retry: metadata and listing requests included.
+        """
+        def _timed():
+            start = time.time()
+            result = func()
+            if callable(self._cb_request):
+                self._cb_request(time.time() - start)
+            return result
+        return retry_call(_timed, self._retries, self._cb_retry)
+
+    def _map_parts(self, func, parts, size):
+        """run func(*part) for every part of a transfer of size bytes, return results in order
+
+        Parts run in the shared part pool (smaller transfers first) or in a pool of this transfer.
+        """
+        if self._part_pool is not None:
+            return self._part_pool.map(func, parts, priority=size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=s3split.common.MULTIPART_CONCURRENCY) as executor:
+            futures = [executor.submit(func, *part) for part in parts]
+            return [future.result() for future in futures]
+
+    def _parts(self, size):
+        """yield (part number, offset, length) for a multipart transfer"""
+        chunksize = s3split.common.MULTIPART_CHUNKSIZE
+        for number, offset in enumerate(range(0, size, chunksize), start=1):
+            yield number, offset, min(chunksize, size - offset)
+
     def download_file(self, s3_object, s3_size, file):
-        """download object from s3"""
+        """download object from s3, big objects are downloaded with parallel ranged gets written in place
+
+        :param file: a real file opened in binary write mode, parts are written with os.pwrite
+        """
         full_path = os.path.join(self.s3_path, s3_object)
         progress = ProgressPercentage(self._cb_stats_update, full_path, s3_size)
-        config = TransferConfig(multipart_threshold=1024 * 1024 * 64, max_concurrency=8,
-                                multipart_chunksize=1024 * 1024 * 64, use_threads=True)
+
+        def _get(offset=None, length=None):
+            def _read():
+                if offset is None:
+                    return self._backend.get_object(self.s3_bucket, full_path)
+                return self._backend.get_object(self.s3_bucket, full_path, offset, offset + length)
+            data = self._retry(_read)
+            os.pwrite(file.fileno(), data, offset or 0)
+            progress(len(data))
         try:
-            self._s3_client.download_fileobj(self.s3_bucket, full_path, file, Config=config, Callback=progress)
+            if s3_size is None or s3_size < s3split.common.MULTIPART_THRESHOLD:
+                _get()
+            else:
+                self._map_parts(_get, [(offset, length) for _, offset, length in self._parts(s3_size)], s3_size)
             return full_path
         except ClientError as ex:
             self._wrap_exception(ex)
 
     def upload_file(self, fs_path):
-        """upload a single file with multiple parallel (concurrency) worlkers"""
-        config = TransferConfig(multipart_threshold=1024 * 1024 * 64, max_concurrency=8,
-                                multipart_chunksize=1024 * 1024 * 64, use_threads=True)
+        """upload a single file, big files are uploaded in parallel multipart, only failed parts are retried"""
         final_path = self.s3_path+'/'+os.path.basename(fs_path)
-        progress = ProgressPercentage(self._cb_stats_update, fs_path, os.path.getsize(fs_path))
+        size = os.path.getsize(fs_path)
+        progress = ProgressPercentage(self._cb_stats_update, fs_path, size)
+        try:
+            if size < s3split.common.MULTIPART_THRESHOLD:
+                with open(fs_path, 'rb') as file:
+                    body = file.read()
+                self._retry(lambda: self._backend.put_object(self.s3_bucket, final_path, body))
+                progress(size)
+            else:
+                self._multipart_upload(fs_path, final_path, size, progress)
+        except ClientError as ex:
+            self._wrap_exception(ex)
+
+    def _resume_multipart(self, key, size):
+        """return (upload id, completed parts) of a saved upload for key, completed parts are checked against S3"""
+        saved = self._multipart_state.get(key) if self._multipart_state is not None else None
+        if saved is None or saved['size'] != size or saved['chunksize'] != s3split.common.MULTIPART_CHUNKSIZE:
+            return None, {}
+        try:
+            remote = self._backend.list_parts(self.s3_bucket, key, saved['upload_id'])
+        except s3split.storage.NotFound:
+            self._logger.warning(f"{key} saved multipart upload not found on S3, restart upload")
+            return None, {}
+        parts = {int(number): etag for number, etag in saved['parts'].items() if remote.get(int(number)) == etag}
+        self._logger.info(f"{key} resume multipart upload {saved['upload_id']} with {len(parts)} completed parts")
+        return saved['upload_id'], parts
+
+    def _multipart_upload(self, fs_path, key, size, progress):
+        upload_id, completed = self._resume_multipart(key, size)
+        if upload_id is None:
+            upload_id = self._retry(lambda: self._backend.create_multipart_upload(self.s3_bucket, key))
+            if self._multipart_state is not None:
+                self._multipart_state.start(key, upload_id, size, s3split.common.MULTIPART_CHUNKSIZE)
+
+        def _upload_part(number, offset, length):
+            with open(fs_path, 'rb') as file:
+                file.seek(offset)
+                data = file.read(length)
+            etag = completed.get(number)
+            # A saved part is reused only if local data did not change (part etag is the md5 of part data)
+            if etag is None or etag.strip('"') != hashlib.md5(data).hexdigest():
+                etag = self._retry(lambda: self._backend.upload_part(self.s3_bucket, key, upload_id, number, data))
+                if self._multipart_state is not None:
+                    self._multipart_state.part_done(key, number, etag)
+            progress(length)
+            return {'PartNumber': number, 'ETag': etag}
+        parts = self._map_parts(_upload_part, list(self._parts(size)), size)
+        self._retry(lambda: self._backend.complete_multipart_upload(self.s3_bucket, key, upload_id, parts))
+        if self._multipart_state is not None:
+            self._multipart_state.done(key)
+
+    def tar_members(self, s3_object, s3_size):
+        """list members of a remote tar reading only tar headers, return tuples (tarinfo, start, end)
+
+        start and end are the byte range of the whole member (extended headers, header, data and padding).
+        """
+        full_path = os.path.join(self.s3_path, s3_object)
+        reader = S3RangeReader(self._backend, self.s3_bucket, full_path, s3_size, retries=self._retries, cb_retry=self._cb_retry)
+        members = []
+        try:
+            with tarfile.open(fileobj=reader, mode='r:') as tar:
+                for tarinfo in tar:
+                    padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE if tarinfo.isreg() else 0
+                    members.append((tarinfo, tarinfo.offset, tarinfo.offset_data + padded))
+        except ClientError as ex:
+            self._wrap_exception(ex)
+        self._logger.debug(f"{full_path} index read with {reader.requests} requests")
+        return members
+
+    def compose_object(self, s3_object, pieces, source_bucket=None):
+        """build an object from pieces: bytes or (key, start, end) ranges of objects in source_bucket, return object size
+
+        Ranges are copied server side with UploadPartCopy, only small ranges are downloaded to fill a part.
+        """
+        key = os.path.join(self.s3_path, s3_object)
+        source_bucket = source_bucket or self.s3_bucket
+        parts = plan_compose_parts(pieces)
+        total_size = sum(len(piece) if isinstance(piece, bytes) else piece[2] - piece[1] for piece in pieces)
+        progress = ProgressPercentage(self._cb_stats_update, key, total_size)
+
+        def _upload_part(number, part):
+            if part[0] == 'copy':
+                _, source_key, start, end = part
+                etag = self._retry(lambda: self._backend.upload_part_copy(self.s3_bucket, key, upload_id, number,
+                                                                          source_bucket, source_key, start, end))
+                size = end - start
+            else:
+                data = []
+                for segment in part[1]:
+                    if isinstance(segment, bytes):
+                        data.append(segment)
+                    else:
+                        source_key, start, end = segment
+                        data.append(self._retry(lambda: self._backend.get_object(source_bucket, source_key, start, end)))
+                body = b"".join(data)
+                etag = self._retry(lambda: self._backend.upload_part(self.s3_bucket, key, upload_id, number, body))
+                size = len(body)
+            progress(size)
+            return {'PartNumber': number, 'ETag': etag}
+        try:
+            upload_id = self._retry(lambda: self._backend.create_multipart_upload(self.s3_bucket, key))
+            try:
+                results = self._map_parts(_upload_part, list(enumerate(parts, start=1)), total_size)
+                self._retry(lambda: self._backend.complete_multipart_upload(self.s3_bucket, key, upload_id, results))
+            except Exception:
+                self._backend.abort_multipart_upload(self.s3_bucket, key, upload_id)
+                raise
+            return total_size
+        except ClientError as ex:
+            self._wrap_exception(ex)
+
+    def abort_multipart_uploads(self, keep=None):
+        """abort orphaned multipart uploads under s3 path, upload ids in keep are left for a later resume"""
+        aborted = 0
         try:
-            self._s3_client.upload_file(fs_path, self.s3_bucket, final_path,
-                                        Config=config,
-                                        Callback=progress
-                                        )
+            # Trailing '/': uploads of a sibling path with the same prefix (path-other) belong to another dataset
+            uploads = self._retry(lambda: self._backend.list_multipart_uploads(self.s3_bucket, self.s3_path.rstrip('/') + '/'))
+            for upload in uploads:
+                if keep is not None and upload['UploadId'] in keep:
+                    continue
+                self._logger.info(f"Abort orphaned multipart upload {upload['Key']} - {upload['UploadId']}")
+                self._retry(lambda upload=upload: self._backend.abort_multipart_upload(self.s3_bucket, upload['Key'], upload['UploadId']))
+                aborted += 1
+            return aborted
         except ClientError as ex:
             self._wrap_exception(ex)
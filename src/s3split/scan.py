@@ -0,0 +1,89 @@
+"""directory scan with an optional persistent cache of unchanged directories"""
+import os
+import time
+import array
+import sqlite3
+
+
+class ScanCache():
+    """SQLite cache of directory entries: directory mtime, file names with sizes and sub directories
+
+    A directory is read again only if its mtime changed. A file changed in place does not update the
+    directory mtime, its cached size is used for planning: a whole file is stored as it is when the tar is
+    built, a tar with segments of a file whose size changed fails.
+    """
+    # Directories modified in the last seconds can change again within the same mtime: do not cache them
+    _RACY_SECONDS = 2
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, files BLOB, sizes BLOB, "
+                         "subdirs BLOB, run INTEGER)")
+        self._run = int(time.time() * 1000)
+        self._updates = []
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _encode(names):
+        return "\0".join(names).encode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def _decode(blob):
+        return blob.decode('utf-8', 'surrogateescape').split("\0") if len(blob) > 0 else []
+
+    def get(self, path, mtime_ns):
+        """return (files, subdirs) of an unchanged directory or None, files is a list of (name, size)"""
+        row = self._db.execute("SELECT mtime_ns, files, sizes, subdirs FROM dirs WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != mtime_ns:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute("UPDATE dirs SET run = ? WHERE path = ?", (self._run, path))
+        sizes = array.array('Q')
+        sizes.frombytes(row[2])
+        return list(zip(self._decode(row[1]), sizes)), self._decode(row[3])
+
+    def put(self, path, mtime_ns, files, subdirs):
+        """save entries of a scanned directory"""
+        if time.time() - mtime_ns / 1e9 < self._RACY_SECONDS:
+            return
+        sizes = array.array('Q', [size for _, size in files])
+        self._updates.append((path, mtime_ns, self._encode([name for name, _ in files]), sizes.tobytes(),
+                              self._encode(subdirs), self._run))
+
+    def close(self, root):
+        """save scanned directories and remove directories under root not seen in this run"""
+        self._db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)", self._updates)
+        self._db.execute("DELETE FROM dirs WHERE run != ? AND (path = ? OR substr(path, 1, ?) = ?)",
+                         (self._run, root, len(root) + 1, root.rstrip('/') + '/'))
+        self._db.commit()
+        self._db.close()
+
+
+def scan_tree(path, cache=None):
+    """walk top down like os.walk, yield (dirpath, [(file name, size)]), unchanged directories are read from cache"""
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        cached = None
+        if cache is not None:
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+            cached = cache.get(dirpath, mtime_ns)
+        if cached is not None:
+            files, subdirs = cached
+        else:
+            files = []
+            subdirs = []
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    # Same as os.walk: links to directories are listed as directories but not walked
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                    else:
+                        files.append((entry.name, entry.stat().st_size))
+            if cache is not None:
+                cache.put(dirpath, mtime_ns, files, subdirs)
+        yield dirpath, files
+        stack.extend(os.path.join(dirpath, subdir) for subdir in reversed(subdirs))
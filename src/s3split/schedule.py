@@ -0,0 +1,87 @@
+"""makespan aware scheduling: largest processing time first ordering and a shared pool of multipart parts"""
+import queue
+import itertools
+import threading
+import concurrent.futures
+import s3split.common
+
+# Cost model defaults: bytes per second of a single tar transfer and files added to/extracted from a tar per second
+BYTE_RATE = 50 * 1024 * 1024
+FILE_RATE = 500
+
+
+def split_cost(split, byte_rate=BYTE_RATE, file_rate=FILE_RATE):
+    """expected seconds to process a split: bytes to transfer plus a per file overhead (open, tar header, small writes)"""
+    return split.get('size') / byte_rate + s3split.common.split_files(split) / file_rate
+
+
+def lpt_order(items, cost):
+    """largest processing time first: expensive items start early instead of running alone at the end (stable for ties)"""
+    return sorted(items, key=cost, reverse=True)
+
+
+class PartPool():
+    """Workers shared by the multipart parts of all running transfers
+
+    Parts are queued by priority, parts of small transfers first: their tar threads are released quickly to start
+    new tars, while idle workers take the parts of big transfers (started first in LPT order). The last big tars
+    are not left with the few threads of their own transfer. Workers are started on demand up to `max_workers`.
+    """
+    _STOP = object()
+
+    def __init__(self, max_workers):
+        self._max_workers = max_workers
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0
+
+    def _run(self):
+        while True:
+            _, _, item = self._queue.get()
+            if item is self._STOP:
+                break
+            future, func, args = item
+            with self._lock:
+                self._idle -= 1
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except BaseException as exc:  # pylint: disable=broad-except
+                    future.set_exception(exc)
+            with self._lock:
+                self._idle += 1
+
+    def submit(self, func, *args, priority=0):
+        """queue func(*args), lower priority values run first"""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._idle <= self._queue.qsize() and len(self._threads) < self._max_workers:
+                thread = threading.Thread(target=self._run, daemon=True, name=f"s3split-part-{len(self._threads)}")
+                self._threads.append(thread)
+                self._idle += 1
+                thread.start()
+        self._queue.put((priority, next(self._sequence), (future, func, args)))
+        return future
+
+    def map(self, func, items, priority=0):
+        """run func(*item) for every item and return results in order, on the first error pending items are cancelled"""
+        futures = [self.submit(func, *item, priority=priority) for item in items]
+        try:
+            return [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+
+    def close(self):
+        """stop workers when queued parts are completed"""
+        with self._lock:
+            threads = list(self._threads)
+            self._threads = []
+        for _ in threads:
+            # Stop markers run after every queued part
+            self._queue.put((float('inf'), next(self._sequence), self._STOP))
+        for thread in threads:
+            thread.join()
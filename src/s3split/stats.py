@@ -1,12 +1,6 @@
 """global stats"""
-import os
 import time
 import threading
-import traceback
-import concurrent.futures
-import tarfile
-import tempfile
-import s3split.s3util
 import s3split.common
 import s3split.common as com
 
@@ -21,7 +15,11 @@ class Stats():
         self._total_size = total_size
         self._stats = {}
         self._byte_sent = 0
+        self._completed = 0
         self._update_count = 0
+        self._counters = {}
+        # Names of values written with set(): they can go down, exported as gauges
+        self._gauges = set()
         self._time_start = time.time()
         self._time_update = 0
         self._time_print_stat = time.time()
@@ -46,12 +44,32 @@ class Stats():
                 msg += f" - {file} ({com.percent(stat['transferred'], stat['size'])}%)\n"
         txt = (f"\n --- stats ---\nElapsed time: {elapsed_time} seconds\n"
                f"Data sent: {com.sizeof_fmt(self._byte_sent)} of {com.sizeof_fmt(self._total_size)} ({com.percent(self._byte_sent, self._total_size)}%)\n"
-               f"Data processing rate: {com.sizeof_fmt((self._byte_sent)/elapsed_time)}\n"
+               f"Data processing rate: {com.sizeof_fmt((self._byte_sent)/max(elapsed_time, 0.1))}\n"
                f"File completed: {completed} of {self._total_file} ({com.percent(completed, self._total_file)}%)")
+        for name, value in list(self._counters.items()):
+            txt += f"\n{name}: {value}"
         if len(msg) > 0:
             txt += f"\nFile(s) in progress:\n{msg}"
         self._logger.info(txt)
 
+    def snapshot(self):
+        """copy of current values for metrics exporters"""
+        with self._lock:
+            return {'bytes_transferred': self._byte_sent, 'bytes_total': self._total_size, 'files_total': self._total_file,
+                    'files_completed': self._completed, 'elapsed': round(time.time() - self._time_start, 1),
+                    'counters': dict(self._counters), 'gauges': sorted(self._gauges)}
+
+    def incr(self, name, value=1):
+        """increment a named counter printed with stats"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """set a named value printed with stats"""
+        with self._lock:
+            self._counters[name] = value
+            self._gauges.add(name)
+
     def update(self, file, byte, total_size):
         """update byte sent for a file"""
         with self._lock:
@@ -60,8 +78,9 @@ class Stats():
                 self._stats[file] = {'size': total_size, 'transferred': 0, 'completed': False}
             self._stats[file]['transferred'] += byte
             self._byte_sent += byte
-            if self._stats[file]['transferred'] == self._stats[file]['size']:
+            if self._stats[file]['transferred'] == self._stats[file]['size'] and not self._stats[file]['completed']:
                 self._stats[file]['completed'] = True
+                self._completed += 1
             self._update_count += 1
             if time.time() - self._time_print_stat > self._interval:
                 self._time_print_stat = time.time()
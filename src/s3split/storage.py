@@ -0,0 +1,429 @@
+"""storage backends: object store operations used by S3Manager (put, get, range get, list, multipart)
+
+S3 is implemented with boto3 in s3util.S3Backend. This module does not import boto3 and provides local backends
+selected by the endpoint url:
+
+- file:///path/to/root stores objects as files, a bucket is a directory of root (stage datasets on local NVMe/NFS)
+- mem://name keeps objects in memory, every backend of the same name in a process shares data (offline tests)
+
+Both accept `latency` (ms per request) and `bandwidth` (MB/s per request stream) query parameters to simulate a
+remote endpoint, e.g. mem://bench?latency=20&bandwidth=100
+"""
+import os
+import io
+import json
+import time
+import uuid
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs
+
+LOCAL_SCHEMES = ('file', 'mem')
+# Parts of multipart uploads are objects of a hidden bucket: uploads of the file backend survive a restart
+UPLOADS_BUCKET = ".s3split-uploads"
+
+
+class NotFound(Exception):
+    """missing bucket, object or multipart upload"""
+
+
+class Backend():
+    """Object store interface, keys are '/' separated strings inside a bucket
+
+    Listed objects are dicts with 'Key', 'Size' and 'ETag' (like S3 list results), parts are dicts with 'PartNumber'
+    and 'ETag'. Byte ranges are [start, end) and NotFound is raised for missing objects and uploads.
+    """
+
+    def bucket_exists(self, bucket):
+        """True if bucket exists"""
+        raise NotImplementedError
+
+    def create_bucket(self, bucket):
+        """create a bucket"""
+        raise NotImplementedError
+
+    def list_objects(self, bucket, prefix):
+        """objects with a key starting with prefix, sorted by key"""
+        raise NotImplementedError
+
+    def put_object(self, bucket, key, body):
+        """store bytes or a binary file object"""
+        raise NotImplementedError
+
+    def get_object(self, bucket, key, start=None, end=None):
+        """object data, a byte range when start and end are given"""
+        raise NotImplementedError
+
+    def open_object(self, bucket, key):
+        """readable binary stream of an object"""
+        raise NotImplementedError
+
+    def delete_object(self, bucket, key):
+        """delete an object"""
+        raise NotImplementedError
+
+    def create_multipart_upload(self, bucket, key):
+        """start a multipart upload, return the upload id"""
+        raise NotImplementedError
+
+    def upload_part(self, bucket, key, upload_id, number, data):
+        """upload a part, return its etag"""
+        raise NotImplementedError
+
+    def upload_part_copy(self, bucket, key, upload_id, number, source_bucket, source_key, start, end):
+        """copy a byte range of another object as a part, return its etag"""
+        raise NotImplementedError
+
+    def list_parts(self, bucket, key, upload_id):
+        """uploaded parts {part number: etag}"""
+        raise NotImplementedError
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        """build the object from parts"""
+        raise NotImplementedError
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        """abort a multipart upload and drop its parts"""
+        raise NotImplementedError
+
+    def list_multipart_uploads(self, bucket, prefix):
+        """multipart uploads in progress, dicts with 'Key' and 'UploadId'"""
+        raise NotImplementedError
+
+
+def _etag(data):
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+class LocalBackend(Backend):
+    """Backend of local storage with an injected per request latency (seconds) and bandwidth (bytes per second)
+
+    Subclasses store objects (_read, _write, _keys, ...), multipart uploads are built on top of them.
+    """
+
+    def __init__(self, latency=0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _throttle(self, size=0, request=True):
+        """sleep the simulated request latency and transfer time of size bytes"""
+        if request:
+            with self._lock:
+                self.requests += 1
+        delay = (self.latency if request else 0) + (size / self.bandwidth if self.bandwidth else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    # Storage primitives
+    def _has_bucket(self, bucket):
+        raise NotImplementedError
+
+    def _make_bucket(self, bucket):
+        raise NotImplementedError
+
+    def _keys(self, bucket, prefix):
+        """[(key, size, etag)] of objects starting with prefix"""
+        raise NotImplementedError
+
+    def _read(self, bucket, key, start=None, end=None):
+        raise NotImplementedError
+
+    def _write(self, bucket, key, chunks):
+        """store an object from an iterable of bytes, readers never see a partial object"""
+        raise NotImplementedError
+
+    def _delete(self, bucket, key):
+        raise NotImplementedError
+
+    # Backend
+    def bucket_exists(self, bucket):
+        self._throttle()
+        return self._has_bucket(bucket)
+
+    def create_bucket(self, bucket):
+        self._throttle()
+        self._make_bucket(bucket)
+
+    def list_objects(self, bucket, prefix):
+        self._throttle()
+        if not self._has_bucket(bucket):
+            raise NotFound(f"bucket {bucket} not found")
+        return [{'Key': key, 'Size': size, 'ETag': etag} for key, size, etag in sorted(self._keys(bucket, prefix))]
+
+    def put_object(self, bucket, key, body):
+        if not self._has_bucket(bucket):
+            raise NotFound(f"bucket {bucket} not found")
+        data = body if isinstance(body, bytes) else body.read()
+        self._throttle(len(data))
+        self._write(bucket, key, [data])
+
+    def get_object(self, bucket, key, start=None, end=None):
+        data = self._read(bucket, key, start, end)
+        self._throttle(len(data))
+        return data
+
+    def open_object(self, bucket, key):
+        self._throttle()
+        return _ThrottledReader(io.BytesIO(self._read(bucket, key)), self)
+
+    def delete_object(self, bucket, key):
+        self._throttle()
+        self._delete(bucket, key)
+
+    def _upload(self, upload_id):
+        try:
+            return json.loads(self._read(UPLOADS_BUCKET, f"{upload_id}/upload"))
+        except NotFound:
+            raise NotFound(f"multipart upload {upload_id} not found")
+
+    def create_multipart_upload(self, bucket, key):
+        self._throttle()
+        if not self._has_bucket(bucket):
+            raise NotFound(f"bucket {bucket} not found")
+        upload_id = uuid.uuid4().hex
+        self._make_bucket(UPLOADS_BUCKET)
+        self._write(UPLOADS_BUCKET, f"{upload_id}/upload", [json.dumps({'bucket': bucket, 'key': key}).encode('utf-8')])
+        return upload_id
+
+    def _write_part(self, upload_id, number, data):
+        self._upload(upload_id)
+        etag = _etag(data)
+        # Part key carries its etag: listing parts does not read them
+        for old, _, _ in self._keys(UPLOADS_BUCKET, f"{upload_id}/{number:05d}-"):
+            self._delete(UPLOADS_BUCKET, old)
+        self._write(UPLOADS_BUCKET, f"{upload_id}/{number:05d}-{etag.strip(chr(34))}", [data])
+        return etag
+
+    def upload_part(self, bucket, key, upload_id, number, data):
+        self._throttle(len(data))
+        return self._write_part(upload_id, number, data)
+
+    def upload_part_copy(self, bucket, key, upload_id, number, source_bucket, source_key, start, end):
+        # Server side copy: data does not cross the simulated link
+        self._throttle()
+        return self._write_part(upload_id, number, self._read(source_bucket, source_key, start, end))
+
+    def list_parts(self, bucket, key, upload_id):
+        self._throttle()
+        self._upload(upload_id)
+        parts = {}
+        for part_key, _, _ in self._keys(UPLOADS_BUCKET, f"{upload_id}/"):
+            name = part_key.split('/')[-1]
+            if name != "upload":
+                number, etag = name.split('-')
+                parts[int(number)] = f'"{etag}"'
+        return parts
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        self._throttle()
+        uploaded = self.list_parts(bucket, key, upload_id)
+        for part in parts:
+            if uploaded.get(part['PartNumber']) != part['ETag']:
+                raise ValueError(f"multipart upload {upload_id} part {part['PartNumber']} not found with etag {part['ETag']}")
+        part_keys = [f"{upload_id}/{part['PartNumber']:05d}-{part['ETag'].strip(chr(34))}" for part in parts]
+        self._write(bucket, key, (self._read(UPLOADS_BUCKET, part_key) for part_key in part_keys))
+        self.abort_multipart_upload(bucket, key, upload_id)
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        self._throttle()
+        self._upload(upload_id)
+        for part_key, _, _ in self._keys(UPLOADS_BUCKET, f"{upload_id}/"):
+            self._delete(UPLOADS_BUCKET, part_key)
+
+    def list_multipart_uploads(self, bucket, prefix):
+        self._throttle()
+        uploads = []
+        if not self._has_bucket(UPLOADS_BUCKET):
+            return uploads
+        for upload_key, _, _ in self._keys(UPLOADS_BUCKET, ""):
+            if upload_key.endswith("/upload"):
+                upload = json.loads(self._read(UPLOADS_BUCKET, upload_key))
+                if upload['bucket'] == bucket and upload['key'].startswith(prefix):
+                    uploads.append({'Key': upload['key'], 'UploadId': upload_key.split('/')[0]})
+        return uploads
+
+
+class _ThrottledReader(io.RawIOBase):
+    """stream of an object read at the simulated bandwidth"""
+
+    def __init__(self, stream, backend):
+        super().__init__()
+        self._stream = stream
+        self._backend = backend
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._backend._throttle(len(data), request=False)  # pylint: disable=protected-access
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._stream.close()
+        super().close()
+
+
+class _MemoryStore():
+    """objects of a named in-memory store {bucket: {key: bytes}}"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+
+class MemoryBackend(LocalBackend):
+    """Objects in memory, backends opened with the same name share a store"""
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, name=None, latency=0, bandwidth=None):
+        super().__init__(latency, bandwidth)
+        if name is None:
+            self._store = _MemoryStore()
+        else:
+            with self._stores_lock:
+                self._store = self._stores.setdefault(name, _MemoryStore())
+
+    @classmethod
+    def drop(cls, name):
+        """forget a named store"""
+        with cls._stores_lock:
+            cls._stores.pop(name, None)
+
+    def _has_bucket(self, bucket):
+        return bucket in self._store.buckets
+
+    def _make_bucket(self, bucket):
+        with self._store.lock:
+            self._store.buckets.setdefault(bucket, {})
+
+    def _keys(self, bucket, prefix):
+        with self._store.lock:
+            objects = list(self._store.buckets.get(bucket, {}).items())
+        return [(key, len(data), _etag(data)) for key, data in objects if key.startswith(prefix)]
+
+    def _read(self, bucket, key, start=None, end=None):
+        data = self._store.buckets.get(bucket, {}).get(key)
+        if data is None:
+            raise NotFound(f"object {bucket}/{key} not found")
+        return data if start is None else data[start:end]
+
+    def _write(self, bucket, key, chunks):
+        data = b"".join(chunks)
+        with self._store.lock:
+            self._store.buckets[bucket][key] = data
+
+    def _delete(self, bucket, key):
+        with self._store.lock:
+            self._store.buckets.get(bucket, {}).pop(key, None)
+
+
+class FileBackend(LocalBackend):
+    """Objects as files under root/bucket/key, written to a temporary file and renamed"""
+
+    def __init__(self, root, latency=0, bandwidth=None):
+        super().__init__(latency, bandwidth)
+        self.root = os.path.abspath(root)
+
+    def _path(self, bucket, key=""):
+        if '..' in bucket.split('/') + key.split('/') or bucket.startswith('/'):
+            raise ValueError(f"Unsafe object key {bucket}/{key}")
+        return os.path.join(self.root, bucket, key)
+
+    def _has_bucket(self, bucket):
+        return os.path.isdir(self._path(bucket))
+
+    def _make_bucket(self, bucket):
+        os.makedirs(self._path(bucket), exist_ok=True)
+
+    def _keys(self, bucket, prefix):
+        base = self._path(bucket)
+        start = os.path.join(base, os.path.dirname(prefix))
+        keys = []
+        for dirpath, _, filenames in os.walk(start):
+            for filename in filenames:
+                if '.s3split-tmp-' in filename:
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, base).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    stat = os.stat(path)
+                    keys.append((key, stat.st_size, f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'))
+        return keys
+
+    def _read(self, bucket, key, start=None, end=None):
+        try:
+            with open(self._path(bucket, key), 'rb') as file:
+                if start is None:
+                    return file.read()
+                file.seek(start)
+                return file.read(end - start)
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise NotFound(f"object {bucket}/{key} not found")
+
+    def _write(self, bucket, key, chunks):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.s3split-tmp-{uuid.uuid4().hex}")
+        try:
+            with open(temp, 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def _delete(self, bucket, key):
+        path = self._path(bucket, key)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        # No empty directories are left, like keys of an object store
+        directory = os.path.dirname(path)
+        while directory != self._path(bucket).rstrip('/'):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def open_object(self, bucket, key):
+        self._throttle()
+        try:
+            return _ThrottledReader(open(self._path(bucket, key), 'rb'), self)
+        except (FileNotFoundError, IsADirectoryError):
+            raise NotFound(f"object {bucket}/{key} not found")
+
+
+def is_local(endpoint):
+    """True for endpoints of a local backend (file://, mem://)"""
+    return endpoint is not None and urlparse(endpoint).scheme in LOCAL_SCHEMES
+
+
+def open_backend(endpoint):
+    """local backend of an endpoint url, latency (ms) and bandwidth (MB/s) are read from query parameters"""
+    url = urlparse(endpoint)
+    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    unknown = sorted(set(query) - {'latency', 'bandwidth'})
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown option(s) {', '.join(unknown)} in storage endpoint {endpoint}")
+    latency = float(query.get('latency', 0)) / 1000
+    bandwidth = float(query['bandwidth']) * 1024 * 1024 if 'bandwidth' in query else None
+    if url.scheme == 'file':
+        root = url.netloc + url.path
+        if len(root) == 0:
+            raise ValueError(f"file endpoint {endpoint} needs a root directory: file:///path/to/root")
+        return FileBackend(root, latency, bandwidth)
+    if url.scheme == 'mem':
+        return MemoryBackend(url.netloc + url.path or None, latency, bandwidth)
+    raise ValueError(f"Unknown storage endpoint {endpoint}, local endpoints are file:// and mem://")
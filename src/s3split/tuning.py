@@ -0,0 +1,142 @@
+"""automatic concurrency tuning: additive increase, multiplicative decrease (AIMD)"""
+import time
+import threading
+import contextlib
+import collections
+import s3split.common
+
+
+# Limit changes kept in history: a job running for days does not grow it (and stats printing it) without bound
+HISTORY_SIZE = 20
+
+
+class ConcurrencyController():
+    """Limit concurrent transfers and tune the limit from measured throughput, errors and request latency
+
+    Every `interval` seconds the controller compares throughput with the previous interval:
+    - throttling/errors or a latency spike (mean request time over `latency_factor` times the best seen)
+      multiply the limit by `decrease`
+    - a throughput improvement over `min_gain` adds `increase` to the limit
+    - otherwise the limit is kept and a new increase is tried after `probe_ticks` intervals
+    """
+
+    def __init__(self, min_limit=1, max_limit=32, start=2, interval=5, increase=1, decrease=0.5,
+                 min_gain=0.05, latency_factor=3, probe_ticks=6, cb_change=None):
+        self._logger = s3split.common.get_logger()
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._limit = max(min_limit, min(start, max_limit))
+        self._interval = interval
+        self._increase = increase
+        self._decrease = decrease
+        self._min_gain = min_gain
+        self._latency_factor = latency_factor
+        self._probe_ticks = probe_ticks
+        self._cb_change = cb_change
+        self._active = 0
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._errors = 0
+        self._latency_sum = 0.0
+        self._latency_count = 0
+        self._best_latency = None
+        self._last_rate = None
+        self._hold_ticks = 0
+        self._time_start = time.time()
+        self._time_tick = self._time_start
+        self._stop = threading.Event()
+        self._thread = None
+        # Last HISTORY_SIZE limit changes (seconds since start, limit)
+        self.history = collections.deque([(0.0, self._limit)], maxlen=HISTORY_SIZE)
+
+    @property
+    def limit(self):
+        """current concurrency limit"""
+        return self._limit
+
+    def _set_limit(self, limit, rate):
+        limit = max(self._min_limit, min(self._max_limit, limit))
+        if limit == self._limit:
+            return
+        with self._cond:
+            self._limit = limit
+            self._cond.notify_all()
+        self.history.append((round(time.time() - self._time_start, 1), limit))
+        self._logger.info(f"Auto threads: concurrency set to {limit} (throughput {s3split.common.sizeof_fmt(rate)}/s)")
+        if callable(self._cb_change):
+            self._cb_change(limit, self.history)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """wait until a transfer can start under the current limit"""
+        with self._cond:
+            while self._active >= self._limit:
+                self._cond.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def on_bytes(self, byte):
+        """record transferred bytes"""
+        with self._lock:
+            self._bytes += byte
+
+    def on_error(self):
+        """record a failed (retried) request, throttling included"""
+        with self._lock:
+            self._errors += 1
+
+    def on_request(self, seconds):
+        """record latency of a completed request"""
+        with self._lock:
+            self._latency_sum += seconds
+            self._latency_count += 1
+
+    def tick(self, elapsed=None):
+        """update limit with measures collected since the last tick, elapsed seconds default to the time since the last tick"""
+        now = time.time()
+        with self._lock:
+            elapsed = max(now - self._time_tick if elapsed is None else elapsed, 1e-6)
+            rate = self._bytes / elapsed
+            errors = self._errors
+            latency = self._latency_sum / self._latency_count if self._latency_count > 0 else None
+            self._bytes = 0
+            self._errors = 0
+            self._latency_sum = 0.0
+            self._latency_count = 0
+        self._time_tick = now
+        spike = latency is not None and self._best_latency is not None and latency > self._best_latency * self._latency_factor
+        if latency is not None and (self._best_latency is None or latency < self._best_latency):
+            self._best_latency = latency
+        if errors > 0 or spike:
+            self._logger.warning(f"Auto threads: {errors} error(s), latency spike: {spike} - decrease concurrency")
+            self._set_limit(int(self._limit * self._decrease), rate)
+            self._hold_ticks = 0
+        elif self._last_rate is None or rate > self._last_rate * (1 + self._min_gain) or self._hold_ticks >= self._probe_ticks:
+            self._set_limit(self._limit + self._increase, rate)
+            self._hold_ticks = 0
+        else:
+            self._hold_ticks += 1
+        self._last_rate = rate
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.tick()
+
+    def start(self):
+        """start periodic tuning in a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """stop periodic tuning"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -1,12 +1,34 @@
 "Unit test"
+import io
+import json
+import urllib.request
+import time
+import threading
+import tarfile
 import tempfile
 import subprocess
 import os
+import sys
 from pprint import pformat
 import pytest
+import botocore.exceptions
 import s3split.common
 import s3split.main
 import s3split.s3util
+import s3split.dataset
+import s3split.cache
+import s3split.tuning
+import s3split.metrics
+import s3split.stats
+import s3split.dryrun
+import s3split.scan
+import s3split.api
+import s3split.schedule
+import s3split.plan
+import s3split.journal
+import s3split.actions
+import s3split.storage
+import s3split.dedup
 import common
 
 LOGGER = s3split.common.get_logger()
@@ -66,3 +88,621 @@ def test_split_new():
         # LOGGER.info(pformat(splits))
         # LOGGER.info(f"Files: {ids_file} Folders: {ids_folder} All:{sorted(ids_all)} Directories: {sorted(split_dirs)} {sorted(dirs)}")
         assert ids_file == [6] and ids_folder == [5, 6] and sorted(split_dirs) == sorted(dirs) and ids_all == [i+1 for i in range(6)]
+
+
+@pytest.mark.file
+def test_dataset_shard_tars():
+    "shards are disjoint, cover all tars and shuffle changes with epoch"
+    ids = list(range(1, 11))
+    shards = [s3split.dataset.shard_tars(ids, i, 3, shuffle=True, seed=7, epoch=1) for i in range(3)]
+    merged = sorted(i for shard in shards for i in shard)
+    epoch_0 = s3split.dataset.shard_tars(ids, 0, 1, shuffle=True, seed=7, epoch=0)
+    epoch_1 = s3split.dataset.shard_tars(ids, 0, 1, shuffle=True, seed=7, epoch=1)
+    assert merged == ids and epoch_0 != epoch_1 and sorted(epoch_0) == ids
+
+
+@pytest.mark.file
+def test_dataset_prefetch_stream():
+    "stream a tar through the bounded prefetch buffer"
+    files = {f"s3split/dir/file_{i}.txt": os.urandom(3000 * i) for i in range(1, 6)}
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        for name, content in files.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(content)
+            tar.addfile(tarinfo, io.BytesIO(content))
+    data.seek(0)
+    stream = s3split.dataset.PrefetchStream(data, chunk_size=1000, max_chunks=2)
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        members = {tarinfo.name: tar.extractfile(tarinfo).read() for tarinfo in tar}
+    stream.close()
+    assert members == files
+
+
+@pytest.mark.file
+def test_tar_cache_lru():
+    "cache hit after miss and least recently used entry evicted over budget"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = s3split.cache.TarCache(tmpdir, 2048)
+        keys = [s3split.cache.TarCache.key("bucket", "path", f"s3split-part-{i}.tar", "etag") for i in range(3)]
+        results = []
+        for key in [keys[0], keys[1], keys[0], keys[2], keys[1]]:
+            file, hit, evicted = cache.open(key, 1000, lambda file: file.write(b"x" * 1000))
+            results.append((len(file.read()), hit, evicted))
+            file.close()
+        assert results == [(1000, False, 0), (1000, False, 0), (1000, True, 0), (1000, False, 1000), (1000, False, 1000)]
+
+
+@pytest.mark.file
+def test_retry_call_transient_errors():
+    "retry throttling errors and give up on not retryable errors"
+    throttle = botocore.exceptions.ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'UploadPart')
+    denied = botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}, 'ResponseMetadata': {'HTTPStatusCode': 403}}, 'UploadPart')
+    calls = []
+    retries = []
+
+    def _flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise throttle
+        return "done"
+
+    def _denied():
+        raise denied
+    result = s3split.s3util.retry_call(_flaky, 5, lambda ex, attempt, delay: retries.append(attempt), backoff=0.01)
+    with pytest.raises(botocore.exceptions.ClientError):
+        s3split.s3util.retry_call(_denied, 5, backoff=0.01)
+    assert result == "done" and retries == [1, 2] and s3split.s3util.is_throttle(throttle)
+
+
+@pytest.mark.file
+def test_multipart_state():
+    "multipart upload ids and completed parts survive a new process"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        state = s3split.s3util.MultipartState(os.path.join(tmpdir, "state.json"))
+        state.start("path/s3split-part-1.tar", "id-1", 100, 10)
+        state.part_done("path/s3split-part-1.tar", 1, '"etag-1"')
+        state.start("path/s3split-part-2.tar", "id-2", 100, 10)
+        state.done("path/s3split-part-2.tar")
+        loaded = s3split.s3util.MultipartState(os.path.join(tmpdir, "state.json"))
+        assert loaded.upload_ids() == {"id-1"} and loaded.get("path/s3split-part-1.tar")['parts'] == {"1": '"etag-1"'}
+
+
+@pytest.mark.file
+def test_plan_compose_parts():
+    "small ranges are merged in data parts, only the last part can be smaller than min part"
+    pieces = [("a", 0, 30), ("b", 0, 4), ("b", 10, 13), ("c", 0, 25), b"\0" * 2]
+    parts = s3split.s3util.plan_compose_parts(pieces, min_part=10, max_copy_part=20)
+    sizes = []
+    for part in parts:
+        if part[0] == 'copy':
+            sizes.append(part[3] - part[2])
+        else:
+            sizes.append(sum(len(seg) if isinstance(seg, bytes) else seg[2] - seg[1] for seg in part[1]))
+    assert [part[0] for part in parts] == ['copy', 'copy', 'data', 'copy', 'copy', 'data'] and sizes == [20, 10, 10, 12, 10, 2]
+    assert all(size >= 10 for size in sizes[:-1]) and sum(sizes) == 64
+
+
+@pytest.mark.file
+def test_concurrency_controller_aimd():
+    "concurrency grows while throughput improves and is halved on throttling"
+    controller = s3split.tuning.ConcurrencyController(start=2, max_limit=8)
+    limits = []
+    for byte, error in [(1000, False), (100000, False), (100000, False), (10000000, False), (10000000, True)]:
+        controller.on_bytes(byte)
+        if error:
+            controller.on_error()
+        # Fixed intervals: rates do not depend on the machine load
+        controller.tick(elapsed=1.0)
+        limits.append(controller.limit)
+    assert limits == [3, 4, 4, 5, 2] and [limit for _, limit in controller.history] == [2, 3, 4, 5, 2]
+    # Throttling then a throughput improvement: two changes every round
+    for index in range(100):
+        controller.on_error()
+        controller.tick(elapsed=1.0)
+        controller.on_bytes(1000 * (index + 1))
+        controller.tick(elapsed=1.0)
+    assert len(controller.history) == s3split.tuning.HISTORY_SIZE
+
+
+@pytest.mark.file
+def test_metrics_exporter_and_event_log():
+    "stats are served in OpenMetrics format and events are appended as json lines"
+    stats = s3split.stats.Stats(3600, 2, 200)
+    stats.update("s3split-part-1.tar", 100, 100)
+    stats.incr("Retries", 3)
+    stats.set("Concurrency (auto threads)", 4)
+    exporter = s3split.metrics.MetricsExporter(stats, port=0, labels={'command': 'upload'})
+    exporter.start()
+    body = urllib.request.urlopen(f"http://127.0.0.1:{exporter.port}/metrics").read().decode('utf-8')
+    exporter.stop()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        events = s3split.metrics.EventLog(os.path.join(tmpdir, "events.jsonl"))
+        events.emit("planned", splits=2)
+        events.emit("upload_completed", name="s3split-part-1.tar", bytes=100)
+        events.close()
+        with open(os.path.join(tmpdir, "events.jsonl")) as file:
+            lines = [json.loads(line) for line in file]
+    assert 's3split_bytes_remaining{command="upload"} 100' in body and 's3split_retries_total{command="upload"} 3' in body
+    assert "# TYPE s3split_concurrency_auto_threads gauge" in body and 's3split_concurrency_auto_threads{command="upload"} 4' in body
+    assert body.endswith("# EOF\n") and [line['event'] for line in lines] == ["planned", "upload_completed"]
+
+
+@pytest.mark.file
+def test_dry_run_estimate():
+    "count single PUT and multipart requests for planned tars"
+    chunk = s3split.common.MULTIPART_CHUNKSIZE
+    splits = [{'paths': ['a'], 'size': 1024, 'id': 1}, {'paths': ['b', 'c'], 'size': chunk * 2 + 1, 'id': 2}]
+    result = s3split.dryrun.estimate(splits, bandwidth=1024 * 1024, latency=0.1, threads=2)
+    assert result['requests'] == {'put': 1, 'multipart_uploads': 1, 'parts': 3} and result['total_requests'] == 8
+    assert result['tars'] == 2 and result['files'] == 3 and result['seconds'] > result['bytes'] / (1024 * 1024)
+
+
+@pytest.mark.args
+def test_dry_run_without_boto3():
+    "upload --dry-run does not need S3 credentials and does not import boto3"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        common.generate_random_files(tmpdir, 4, 10)
+        code = ("import sys, s3split.main; "
+                f"s3split.main.run_main(['upload', '{tmpdir}', 's3://bucket/path', '--dry-run']); "
+                "print('boto3' in sys.modules)")
+        src = os.path.abspath(os.path.join(os.path.dirname(__file__), '../src'))
+        env = dict(os.environ, PYTHONPATH=src, S3_SECRET_KEY="", S3_ACCESS_KEY="", S3_ENDPOINT="")
+        output = subprocess.check_output([sys.executable, '-c', code], env=env).decode('utf8')
+        assert output.strip().endswith("False")
+
+
+@pytest.mark.file
+def test_scan_cache():
+    "unchanged directories are read from scan cache, a changed directory is read again"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        for dir in ["dir_a", "dir_b", "dir_b/dir_c"]:
+            common.generate_random_files(os.path.join(source, dir), 3, 1)
+        old = time.time() - 60
+        for dirpath, _, _ in os.walk(source):
+            os.utime(dirpath, (old, old))
+        cache_path = os.path.join(tmpdir, "scan.db")
+        splits_first = s3split.common.split_file_by_size(source, 10 * 1024, cache_path)
+        cache = s3split.scan.ScanCache(cache_path)
+        list(s3split.scan.scan_tree(os.path.abspath(source), cache))
+        hits_unchanged = cache.hits
+        cache.close(os.path.abspath(source))
+        splits_uncached = s3split.common.split_file_by_size(source, 10 * 1024)
+        common.generate_random_files(os.path.join(source, "dir_a"), 4, 1)
+        os.utime(os.path.join(source, "dir_a"), (old + 1, old + 1))
+        cache = s3split.scan.ScanCache(cache_path)
+        scanned = {dirpath: files for dirpath, files in s3split.scan.scan_tree(os.path.abspath(source), cache)}
+        assert splits_first == splits_uncached and hits_unchanged == 4
+        assert cache.hits == 3 and cache.misses == 1 and len(scanned[os.path.abspath(os.path.join(source, "dir_a"))]) == 4
+
+
+@pytest.mark.file
+def test_stripes():
+    "parse stripes, spread bytes by weight and interleave tars between locations"
+    stripe = s3split.common.parse_stripe("http://127.0.0.1:9001,s3://other/data,3")
+    assert stripe == {'endpoint': "http://127.0.0.1:9001", 'bucket': "other", 'path': "data", 'weight': 3.0}
+    with pytest.raises(ValueError):
+        s3split.common.parse_stripe("s3://other/data")
+    splits = [{'id': i + 1, 'size': 100} for i in range(8)]
+    stripes = s3split.common.assign_stripes(splits, [1, 3])
+    assert stripes.count(0) == 2 and stripes.count(1) == 6
+    assert s3split.common.interleave([1, 2, 3, 4, 5], lambda item: item % 2) == [1, 2, 3, 4, 5]
+    assert s3split.common.interleave([1, 3, 5, 2, 4], lambda item: item % 2) == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.args
+def test_api_config_and_client_pool():
+    "library config builds command args with cli defaults, clients are shared by endpoint"
+    config = s3split.api.Config(s3_access_key="a", s3_secret_key="b", s3_endpoint="http://127.0.0.1:9000", threads=3)
+    args = config.args("upload", source="/tmp/data", target="s3://bucket/path", tar_size=10, stripe=["http://other:9000,s3://b2/p"])
+    assert args.command == "upload" and args.threads == 3 and args.tar_size == 10 and args.retries == 5
+    assert args.stripe[0]['bucket'] == "b2"
+    with pytest.raises(ValueError):
+        config.args("upload", source="/tmp/data", target="s3://bucket/path", unknown=1)
+    with pytest.raises(ValueError):
+        s3split.api.Config(s3_access_key="a", s3_secret_key="b", s3_endpoint="http://127.0.0.1:9000", tar_size=1)
+    # Defaults come from the cli parser: every upload option is accepted
+    cli = s3split.main.parse_args(["--s3-access-key", "a", "--s3-secret-key", "b", "--s3-endpoint", "http://127.0.0.1:9000",
+                                   "--threads", "3", "upload", "/tmp/data", "s3://bucket/path", "--tar-size", "10"])
+    assert vars(cli) == vars(config.args("upload", source="/tmp/data", target="s3://bucket/path", tar_size=10))
+    pool = s3split.s3util.ClientPool()
+    manager_1 = s3split.s3util.S3Manager("a", "b", "http://127.0.0.1:9000", True, "bucket", "path", client_pool=pool)
+    manager_2 = s3split.s3util.S3Manager("a", "b", "http://127.0.0.1:9000", True, "bucket", "other", client_pool=pool)
+    assert manager_1.get_client() is manager_2.get_client() and len(pool) == 1
+
+
+@pytest.mark.file
+def test_split_huge_file_segments():
+    "files bigger than max size are cut in contiguous segments spread across splits"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        common.generate_random_files(tmpdir, 3, 1)
+        with open(os.path.join(tmpdir, "huge.bin"), 'wb') as file:
+            file.write(os.urandom(10 * 1024 + 5))
+        splits = s3split.common.split_file_by_size(tmpdir, 4 * 1024)
+        segments = [segment for split in splits for segment in split.get('segments', [])]
+        assert all(split.get('size') <= 4 * 1024 for split in splits)
+        assert [(segment['offset'], segment['length']) for segment in segments] == [(0, 4096), (4096, 4096), (8192, 2053)]
+        assert all(segment['path'] == "huge.bin" and segment['size'] == 10 * 1024 + 5 for segment in segments)
+        assert "huge.bin" not in [path for split in splits for path in split.get('paths')]
+        assert len(s3split.common.split_searh_file(splits, "huge")) == 3
+
+
+@pytest.mark.file
+def test_schedule_lpt_and_part_pool():
+    "largest splits first, queued parts of smaller transfers run first"
+    splits = [{'id': 1, 'size': 10, 'paths': ['a']}, {'id': 2, 'size': 500, 'paths': ['b']}, {'id': 3, 'size': 10, 'paths': ['c']}]
+    assert [split['id'] for split in s3split.schedule.lpt_order(splits, lambda split: split['size'])] == [2, 1, 3]
+    pool = s3split.schedule.PartPool(1)
+    started = []
+    gate = pool.submit(time.sleep, 0.2)
+    futures = [pool.submit(started.append, name, priority=priority) for name, priority in [("big", 500), ("small", 10), ("medium", 100)]]
+    gate.result()
+    for future in futures:
+        future.result()
+    assert started == ["small", "medium", "big"]
+    with pytest.raises(ZeroDivisionError):
+        pool.map(lambda value: 1 / value, [(1,), (0,), (2,)])
+    pool.close()
+
+
+@pytest.mark.file
+def test_plan_compact_splits():
+    "plan splits keep file ranges in arrays and behave like metadata split dicts"
+    plan = s3split.plan.Plan()
+    root = plan.directory('')
+    sub = plan.directory('dir_a/dir_b')
+    assert plan.directory('dir_a/dir_b') == sub
+    plan.add_file(root, "a.txt", 10)
+    plan.add_file(sub, "b.txt", 20)
+    plan.add_split(30)
+    plan.add_file(sub, "cè.txt", 5)
+    plan.add_split(5 + 7, [{'path': 'huge.bin', 'offset': 0, 'length': 7, 'size': 7}])
+    assert len(plan) == 2 and plan.files == 3 and plan.size(1) == 20
+    assert plan[0] == {'paths': ['a.txt', 'dir_a/dir_b/b.txt'], 'size': 30, 'id': 1}
+    assert plan[1].get('paths') == ['dir_a/dir_b/cè.txt'] and plan[1]['segments'][0]['path'] == 'huge.bin'
+    assert s3split.common.split_files(plan[1]) == 2 and plan[0].get('segments', []) == []
+    assert json.loads(json.dumps([split.to_dict() for split in plan]))[1]['id'] == 2
+    assert s3split.common.split_searh_file(plan, "dir_b") == [1, 2]
+
+
+@pytest.mark.file
+def test_download_journal():
+    "journal of extracted tars: resume skips completed tars, tolerates a truncated line and refuses another dataset"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        journal = s3split.journal.DownloadJournal(tmpdir, "s3://bucket/path", "2026-01-01")
+        journal.done("s3split-part-1.tar", None, 3)
+        journal.done("s3split-part-2.tar", "dir_a", 1)
+        journal.close()
+        with open(journal.path, 'a') as file:
+            file.write('{"tar": "s3split-part-3')
+        journal = s3split.journal.DownloadJournal(tmpdir, "s3://bucket/path", "2026-01-01", resume=True)
+        assert len(journal) == 2 and journal.completed("s3split-part-1.tar", "dir_b")
+        assert journal.completed("s3split-part-2.tar", "dir_a") and not journal.completed("s3split-part-2.tar")
+        journal.done("s3split-part-3.tar")
+        journal.close()
+        journal = s3split.journal.DownloadJournal(tmpdir, "s3://bucket/path", "2026-01-01", resume=True)
+        assert len(journal) == 3
+        journal.close()
+        with pytest.raises(ValueError):
+            s3split.journal.DownloadJournal(tmpdir, "s3://bucket/other", "2026-01-01", resume=True)
+        journal = s3split.journal.DownloadJournal(tmpdir, "s3://bucket/other", "2026-01-01")
+        assert len(journal) == 0
+        journal.close(remove=True)
+        assert not os.path.exists(journal.path)
+
+
+@pytest.mark.args
+def test_key_prefixes():
+    "hashed key prefixes are fixed width, spread tar names and resolve tar locations"
+    assert s3split.common.key_prefix("s3split-part-1.tar", 0) is None and s3split.common.key_prefix("s3split-part-1.tar", 1) is None
+    assert s3split.common.key_prefix("s3split-part-1.tar", 16) == s3split.common.key_prefix("s3split-part-1.tar", 16)
+    prefixes = {s3split.common.key_prefix(s3split.common.gen_file_name(i), 256) for i in range(1, 2001)}
+    assert len(prefixes) > 240 and all(len(prefix) == 2 for prefix in prefixes)
+    config = s3split.api.Config(s3_access_key="a", s3_secret_key="b", s3_endpoint="http://127.0.0.1:9000")
+    action = s3split.actions.Action(config.args("check", target="s3://bucket/path"), threading.Event())
+    s3uri = s3split.common.S3Uri("s3://bucket/path")
+    assert action._location({'name': "s3split-part-1.tar"}, s3uri) == ("http://127.0.0.1:9000", s3uri)
+    endpoint, location_uri = action._location({'prefix': "0a"}, s3uri)
+    assert endpoint == "http://127.0.0.1:9000" and (location_uri.bucket, location_uri.object) == ("bucket", "path/0a")
+    endpoint, location_uri = action._location({'prefix': "f", 'location': {'endpoint': "http://other:9000", 'bucket': "b2", 'path': "p"}}, s3uri)
+    assert endpoint == "http://other:9000" and (location_uri.bucket, location_uri.object) == ("b2", "p/f")
+
+
+@pytest.mark.file
+def test_storage_backends():
+    "local backends: objects, byte ranges, listing, multipart uploads and injected latency"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in [s3split.storage.MemoryBackend(), s3split.storage.FileBackend(tmpdir)]:
+            with pytest.raises(s3split.storage.NotFound):
+                backend.put_object("bucket", "path/a", b"data")
+            backend.create_bucket("bucket")
+            assert backend.bucket_exists("bucket") and not backend.bucket_exists("other")
+            backend.put_object("bucket", "path/a", b"0123456789")
+            backend.put_object("bucket", "path/sub/b", io.BytesIO(b"b"))
+            backend.put_object("bucket", "other/c", b"c")
+            assert backend.get_object("bucket", "path/a", 2, 5) == b"234" and backend.open_object("bucket", "path/sub/b").read() == b"b"
+            assert [(obj['Key'], obj['Size']) for obj in backend.list_objects("bucket", "path")] == [("path/a", 10), ("path/sub/b", 1)]
+            with pytest.raises(s3split.storage.NotFound):
+                backend.get_object("bucket", "path/missing")
+            upload_id = backend.create_multipart_upload("bucket", "path/big")
+            etag_1 = backend.upload_part("bucket", "path/big", upload_id, 1, b"head-")
+            etag_2 = backend.upload_part_copy("bucket", "path/big", upload_id, 2, "bucket", "path/a", 0, 4)
+            assert backend.list_parts("bucket", "path/big", upload_id) == {1: etag_1, 2: etag_2}
+            assert backend.list_multipart_uploads("bucket", "path") == [{'Key': "path/big", 'UploadId': upload_id}]
+            backend.complete_multipart_upload("bucket", "path/big", upload_id, [{'PartNumber': 1, 'ETag': etag_1},
+                                                                                 {'PartNumber': 2, 'ETag': etag_2}])
+            assert backend.get_object("bucket", "path/big") == b"head-0123"
+            assert backend.list_multipart_uploads("bucket", "path") == []
+            with pytest.raises(s3split.storage.NotFound):
+                backend.list_parts("bucket", "path/big", upload_id)
+            backend.delete_object("bucket", "path/sub/b")
+            assert [obj['Key'] for obj in backend.list_objects("bucket", "")] == ["other/c", "path/a", "path/big"]
+        s3split.storage.open_backend("mem://shared").create_bucket("bucket")
+        assert s3split.storage.open_backend("mem://shared").bucket_exists("bucket")
+        s3split.storage.MemoryBackend.drop("shared")
+        slow = s3split.storage.open_backend("mem://?latency=20&bandwidth=1")
+        assert slow.latency == 0.02 and slow.bandwidth == 1024 * 1024
+        start = time.time()
+        slow.create_bucket("bucket")
+        slow.put_object("bucket", "a", b"\0" * 102400)
+        assert time.time() - start >= 0.02 * 2 + 0.09 and slow.requests == 2
+        with pytest.raises(ValueError):
+            s3split.storage.open_backend("mem://x?speed=1")
+        assert s3split.storage.is_local(f"file://{tmpdir}") and not s3split.storage.is_local("http://127.0.0.1:9000")
+
+
+@pytest.mark.full
+def test_upload_download_local_backend():
+    "offline upload, check and download with a file:// endpoint (no S3 and no credentials)"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        common.generate_random_files(source, 6, 512)
+        common.generate_random_files(os.path.join(source, "dir_1"), 4, 512)
+        s3split.storage.FileBackend(os.path.join(tmpdir, "store")).create_bucket("bucket")
+        options = ["--s3-endpoint", f"file://{tmpdir}/store", "--threads", "2"]
+        s3split.main.run_main(options + ["upload", source, "s3://bucket/dataset", "--tar-size", "1", "--key-prefixes", "4"])
+        s3split.main.run_main(options + ["check", "s3://bucket/dataset"])
+        s3split.main.run_main(options + ["download", "s3://bucket/dataset", os.path.join(tmpdir, "target")])
+        for dirpath, _, filenames in os.walk(source):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(dirpath, filename), source)
+                with open(os.path.join(source, path), 'rb') as file_source, open(os.path.join(tmpdir, "target", path), 'rb') as file_target:
+                    assert file_source.read() == file_target.read()
+        assert os.path.isfile(os.path.join(tmpdir, "store", "bucket", "dataset", "s3split-metadata.json"))
+
+
+@pytest.mark.file
+def test_dedup_plan():
+    "identical files are planned once, the split of the original lists duplicates"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        content = os.urandom(100 * 1024)
+        for path, data in [("a.bin", content), ("dir/copy.bin", content), ("dir/sub/copy2.bin", content),
+                           ("near.bin", content[:-1] + bytes([content[-1] ^ 1])), ("small_1.txt", b"x" * 10), ("small_2.txt", b"x" * 10),
+                           ("other.bin", os.urandom(50 * 1024))]:
+            os.makedirs(os.path.dirname(os.path.join(tmpdir, path)), exist_ok=True)
+            with open(os.path.join(tmpdir, path), 'wb') as file:
+                file.write(data)
+        splits = s3split.common.split_file_by_size(tmpdir, 120 * 1024, dedup=True, threads=2)
+        paths = sorted(path for split in splits for path in split.get('paths'))
+        assert paths == ["a.bin", "near.bin", "other.bin", "small_1.txt", "small_2.txt"]
+        duplicates = {original: copies for split in splits for original, copies in (split.get('duplicates') or {}).items()}
+        assert duplicates == {"a.bin": ["dir/copy.bin", "dir/sub/copy2.bin"]}
+        split = next(split for split in splits if "a.bin" in split.get('paths'))
+        assert split.to_dict()['duplicates'] == duplicates and s3split.common.split_searh_file(splits, "dir/sub") == [split.id]
+        assert sum(split.size for split in s3split.common.split_file_by_size(tmpdir, 120 * 1024)) - sum(split.size for split in splits) == 2 * len(content)
+        assert s3split.dedup.file_hash(os.path.join(tmpdir, "a.bin"), 10) != s3split.dedup.file_hash(os.path.join(tmpdir, "a.bin"))
+
+
+@pytest.mark.full
+def test_dedup_prefix_download_local_backend():
+    "a prefix download restores duplicates of a segmented original outside prefix"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        huge = os.urandom(int(2.5 * 1024 * 1024))
+        for path, data in [("d1/huge.bin", huge), ("d1/d2/huge_copy.bin", huge), ("d1/small.bin", os.urandom(4096))]:
+            os.makedirs(os.path.dirname(os.path.join(source, path)), exist_ok=True)
+            with open(os.path.join(source, path), 'wb') as file:
+                file.write(data)
+        s3split.storage.FileBackend(os.path.join(tmpdir, "store")).create_bucket("bucket")
+        options = ["--s3-endpoint", f"file://{tmpdir}/store", "--threads", "2"]
+        s3split.main.run_main(options + ["upload", source, "s3://bucket/dataset", "--tar-size", "1", "--dedup"])
+        target = os.path.join(tmpdir, "target")
+        s3split.main.run_main(options + ["download", "s3://bucket/dataset", target, "--prefix", "d1/d2"])
+        files = sorted(os.path.relpath(os.path.join(dirpath, name), target) for dirpath, _, names in os.walk(target) for name in names)
+        assert files == ["d1/d2/huge_copy.bin"]
+        with open(os.path.join(target, "d1/d2/huge_copy.bin"), 'rb') as file:
+            assert file.read() == huge
+        # A duplicate whose original was not extracted fails the download
+        os.remove(os.path.join(target, "d1/d2/huge_copy.bin"))
+        args = s3split.main.parse_args(options + ["download", "s3://bucket/dataset", target, "--prefix", "d1/d2"])
+        action = s3split.actions.Action(args, threading.Event())
+        with pytest.raises(ValueError, match="not extracted"):
+            action._restore_duplicates([{'id': 1, 'duplicates': {"d1/huge.bin": ["d1/d2/huge_copy.bin"]}}], {1}, None)
+
+
+@pytest.mark.full
+def test_upload_segment_changed_size():
+    "a tar with segments of a file grown since planning (cached scan) fails instead of dropping bytes"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        os.makedirs(source)
+        with open(os.path.join(source, "huge.bin"), 'wb') as file:
+            file.write(os.urandom(int(1.5 * 1024 * 1024)))
+        # An old directory mtime is cached by the scan cache
+        os.utime(source, (time.time() - 60, time.time() - 60))
+        s3split.storage.FileBackend(os.path.join(tmpdir, "store")).create_bucket("bucket")
+        options = ["--s3-endpoint", f"file://{tmpdir}/store", "--threads", "2"]
+        upload = ["upload", source, "--tar-size", "1", "--scan-cache", os.path.join(tmpdir, "scan.db")]
+        s3split.main.run_main(options + upload[:2] + ["s3://bucket/dataset_1"] + upload[2:])
+        with open(os.path.join(source, "huge.bin"), 'ab') as file:
+            file.write(os.urandom(500 * 1000))
+        with pytest.raises(SystemExit, match="Upload failed"):
+            s3split.main.run_main(options + upload[:2] + ["s3://bucket/dataset_2"] + upload[2:])
+
+
+@pytest.mark.file
+def test_api_upload_dry_run():
+    "an api upload with dry_run returns an estimate and does not write to the target"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        common.generate_random_files(tmpdir, 6, 512)
+        backend = s3split.storage.open_backend("mem://api-dry-run")
+        backend.create_bucket("bucket")
+        with s3split.api.Uploader(s3_endpoint="mem://api-dry-run", threads=2) as uploader:
+            result = uploader.upload(tmpdir, "s3://bucket/path", tar_size=1, dry_run=True, bandwidth=50)
+        assert result.ok and result.tars == [] and result.estimate['files'] == 6 and result.estimate['tars'] > 1
+        assert backend.list_objects("bucket", "") == []
+
+
+@pytest.mark.full
+def test_repack_local_backend():
+    "repack keeps files and symbolic links, the repacked dataset downloads like the source"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        common.generate_random_files(os.path.join(source, "dir_1"), 6, 300)
+        os.symlink("dir_1/file_1.txt", os.path.join(source, "link.txt"))
+        s3split.storage.FileBackend(os.path.join(tmpdir, "store")).create_bucket("bucket")
+        options = ["--s3-endpoint", f"file://{tmpdir}/store", "--threads", "2"]
+        s3split.main.run_main(options + ["upload", source, "s3://bucket/dataset", "--tar-size", "1"])
+        s3split.main.run_main(options + ["repack", "s3://bucket/dataset", "s3://bucket/repacked", "--tar-size", "2"])
+        target = os.path.join(tmpdir, "target")
+        s3split.main.run_main(options + ["download", "s3://bucket/repacked", target])
+        assert os.readlink(os.path.join(target, "link.txt")) == "dir_1/file_1.txt"
+        for index in range(1, 7):
+            with open(os.path.join(source, f"dir_1/file_{index}.txt"), 'rb') as file_source, \
+                    open(os.path.join(target, f"dir_1/file_{index}.txt"), 'rb') as file_target:
+                assert file_source.read() == file_target.read()
+        metadata = json.loads(s3split.storage.open_backend(f"file://{tmpdir}/store").get_object("bucket", "repacked/s3split-metadata.json"))
+        assert "link.txt" in [path for split in metadata['splits'] for path in split['paths']]
+
+
+@pytest.mark.full
+def test_upload_invalid_options_local_backend():
+    "invalid upload options fail before the metadata file is written to the target"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        common.generate_random_files(os.path.join(tmpdir, "source"), 2, 16)
+        backend = s3split.storage.FileBackend(os.path.join(tmpdir, "store"))
+        backend.create_bucket("bucket")
+        options = ["--s3-endpoint", f"file://{tmpdir}/store", "upload", os.path.join(tmpdir, "source"), "s3://bucket/dataset"]
+        for invalid in [["--target-weight", "0"], ["--key-prefixes", "-1"]]:
+            with pytest.raises(SystemExit, match="must be positive"):
+                s3split.main.run_main(options + invalid)
+        assert backend.list_objects("bucket", "") == []
+
+
+@pytest.mark.full
+def test_dedup_symlink_local_backend():
+    "a symbolic link listed before its target is not a duplicate: both are restored as they are"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        content = os.urandom(64 * 1024)
+        os.makedirs(os.path.join(source, "sub"))
+        with open(os.path.join(source, "sub/real.bin"), 'wb') as file:
+            file.write(content)
+        with open(os.path.join(source, "sub/copy.bin"), 'wb') as file:
+            file.write(content)
+        # The root directory is scanned first: the link comes before its target
+        os.symlink("sub/real.bin", os.path.join(source, "link.bin"))
+        s3split.storage.FileBackend(os.path.join(tmpdir, "store")).create_bucket("bucket")
+        options = ["--s3-endpoint", f"file://{tmpdir}/store", "--threads", "2"]
+        s3split.main.run_main(options + ["upload", source, "s3://bucket/dataset", "--tar-size", "1", "--dedup"])
+        target = os.path.join(tmpdir, "target")
+        s3split.main.run_main(options + ["download", "s3://bucket/dataset", target])
+        assert os.readlink(os.path.join(target, "link.bin")) == "sub/real.bin"
+        for path in ["sub/real.bin", "sub/copy.bin"]:
+            assert not os.path.islink(os.path.join(target, path))
+            with open(os.path.join(target, path), 'rb') as file:
+                assert file.read() == content
+
+
+@pytest.mark.file
+def test_s3_manager_retries_metadata_requests():
+    "metadata, listing and bucket requests are retried like transfers (botocore retries are disabled)"
+    class _FlakyBackend():
+        def __init__(self, backend):
+            self._backend = backend
+            self.failed = set()
+
+        def __getattr__(self, name):
+            method = getattr(self._backend, name)
+
+            def _call(*args):
+                if name not in self.failed:
+                    self.failed.add(name)
+                    raise botocore.exceptions.ClientError({'Error': {'Code': 'ServiceUnavailable'},
+                                                           'ResponseMetadata': {'HTTPStatusCode': 503}}, name)
+                return method(*args)
+            return _call
+    s3split.storage.open_backend("mem://retry-metadata").create_bucket("bucket")
+    retries = []
+    s3_manager = s3split.s3util.S3Manager(None, None, "mem://retry-metadata", True, "bucket", "path",
+                                          cb_retry=lambda ex, attempt, delay: retries.append(attempt))
+    s3_manager._backend = _FlakyBackend(s3_manager.get_client())
+    assert s3_manager.upload_metadata([{'paths': ['a'], 'size': 1, 'id': 1}], None, "x")
+    assert s3_manager.download_metadata()['splits'][0]['paths'] == ['a']
+    assert len(s3_manager.list_bucket_objects()) == 1 and s3_manager.bucket_exsist()
+    assert s3_manager._backend.failed == {'bucket_exists', 'put_object', 'get_object', 'list_objects'} and len(retries) == 4
+
+
+@pytest.mark.file
+def test_abort_multipart_uploads_path_prefix():
+    "orphaned multipart uploads are aborted under the dataset path only, not under sibling paths"
+    backend = s3split.storage.open_backend("mem://abort-prefix")
+    backend.create_bucket("bucket")
+    own = backend.create_multipart_upload("bucket", "ds/s3split-part-1.tar")
+    other = backend.create_multipart_upload("bucket", "ds-other/s3split-part-1.tar")
+    s3_manager = s3split.s3util.S3Manager(None, None, "mem://abort-prefix", True, "bucket", "ds")
+    assert s3_manager.abort_multipart_uploads() == 1
+    assert [upload['UploadId'] for upload in backend.list_multipart_uploads("bucket", "")] == [other] and own != other
+
+
+@pytest.mark.full
+def test_missing_metadata_local_backend():
+    "download and repack of a path without a dataset fail before creating the target"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        s3split.storage.FileBackend(os.path.join(tmpdir, "store")).create_bucket("bucket")
+        options = ["--s3-endpoint", f"file://{tmpdir}/store"]
+        target = os.path.join(tmpdir, "target")
+        with pytest.raises(SystemExit, match="Metadata file not found"):
+            s3split.main.run_main(options + ["download", "s3://bucket/typo", target])
+        with pytest.raises(SystemExit, match="Metadata file not found"):
+            s3split.main.run_main(options + ["repack", "s3://bucket/typo", "s3://bucket/repacked"])
+        assert not os.path.exists(target)
+
+
+@pytest.mark.full
+def test_api_interrupted_download():
+    "a job stopped with its event is interrupted and not ok"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        common.generate_random_files(os.path.join(tmpdir, "source"), 6, 512)
+        s3split.storage.open_backend("mem://api-interrupted").create_bucket("bucket")
+        event = threading.Event()
+
+        def _on_event(name, fields):
+            if name == "tar_extracted":
+                event.set()
+        with s3split.api.Session(s3_endpoint="mem://api-interrupted", threads=1) as session:
+            assert s3split.api.Uploader(session).upload(os.path.join(tmpdir, "source"), "s3://bucket/path", tar_size=1).ok
+            result = s3split.api.Downloader(session).download("s3://bucket/path", os.path.join(tmpdir, "target"),
+                                                              cb_progress=_on_event, event=event)
+        assert result.interrupted and not result.ok and len(result.tars) == 1 and result.failed == []
+
+
+@pytest.mark.full
+def test_dataset_segments_local_backend():
+    "files bigger than tar size are yielded whole once across shards, or skipped on request"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        common.generate_random_files(source, 3, 300)
+        huge = os.urandom(int(2.5 * 1024 * 1024))
+        with open(os.path.join(source, "huge.bin"), 'wb') as file:
+            file.write(huge)
+        s3split.storage.open_backend("mem://dataset-segments").create_bucket("bucket")
+        s3split.main.run_main(["--s3-endpoint", "mem://dataset-segments", "upload", source, "s3://bucket/path", "--tar-size", "1"])
+        files = dict(s3split.dataset.Dataset("s3://bucket/path", s3_endpoint="mem://dataset-segments"))
+        assert sorted(files) == ["file_1.txt", "file_2.txt", "file_3.txt", "huge.bin"] and files["huge.bin"] == huge
+        shards = [[path for path, _ in s3split.dataset.Dataset("s3://bucket/path", s3_endpoint="mem://dataset-segments", shard_index=index,
+                                                               num_shards=2, shuffle=True)] for index in range(2)]
+        assert sorted(shards[0] + shards[1]) == sorted(files)
+        skipped = [path for path, _ in s3split.dataset.Dataset("s3://bucket/path", s3_endpoint="mem://dataset-segments", segments="skip")]
+        assert sorted(skipped) == ["file_1.txt", "file_2.txt", "file_3.txt"]